@@ -0,0 +1,232 @@
+"""
+Local stand-in for the Skypicker, Google Maps Distance Matrix and myGasFeed APIs, for benchmarking without live calls.
+
+Recorded responses in benchmarks/recordings are replayed: airports are filtered to the requested box, flights to the
+requested airports (and moved into the requested dates), and the gas stations response is returned as is. Distance
+Matrix elements are derived from the straight-line distance between the requested coordinates, so that any matrix can
+be answered.
+
+Point the API at it with:
+    SKYPICKER_API_ROUTE=http://127.0.0.1:8100/skypicker
+    GOOGLE_MAPS_API_ROUTE=http://127.0.0.1:8100/maps/api
+    MYGASFEED_API_ROUTE_DEV=http://127.0.0.1:8100/mygasfeed
+
+Usage:
+    python -m benchmarks.fake_upstream --port 8100 --latency-ms 50 --jitter-ms 20 --error-rate 0.01
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+DRIVING_DETOUR_FACTOR = 1.3
+DRIVING_SPEED_METERS_PER_SECOND = 25
+
+
+def _load_recording(name):
+    """ Load a recorded response from the recordings directory """
+    with open(os.path.join(RECORDINGS_PATH, name), "r") as f:
+        return json.load(f)
+
+
+def _get_haversine_distance_meters(lat1, lon1, lat2, lon2):
+    """ Straight-line distance between two coordinates, in meters """
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+class FakeUpstream(object):
+    """ Answers the upstream routes from the recordings, with optional latency and error injection """
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=503, seed=None):
+        """
+        :param latency_ms: float: delay added to every response, in milliseconds
+        :param jitter_ms: float: maximum random delay added on top of `latency_ms`, in milliseconds
+        :param error_rate: float: fraction of requests answered with `error_status`
+        :param error_status: int: HTTP status code of the injected errors
+        :param seed: int: seed of the random latency and errors, for repeatable runs
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.locations = _load_recording("locations.json")["locations"]
+        self.flights = _load_recording("flights.json")["data"]
+        self.gas_stations = _load_recording("gas_stations.json")
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle(self, path, query):
+        """
+        Answer a request
+        :param path: string: path of the request URL
+        :param query: dict: query string parameters, each with a list of values
+        :return: tuple: HTTP status code and response body
+        """
+        if path == "/_stats":
+            with self._lock:
+                return 200, json.dumps(dict(self.calls))
+        if path == "/_reset":
+            with self._lock:
+                self.calls.clear()
+            return 200, "{}"
+
+        if path.endswith("/locations"):
+            route = "locations"
+        elif path.endswith("/flights"):
+            route = "flights"
+        elif path.endswith("/distancematrix/json"):
+            route = "distancematrix"
+        elif path.startswith("/mygasfeed/"):
+            route = "gas_stations"
+        else:
+            return 404, json.dumps({"error": "unknown route {}".format(path)})
+
+        with self._lock:
+            self.calls[route] += 1
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            is_error = self._random.random() < self.error_rate
+        time.sleep(delay / 1000)
+        if is_error:
+            return self.error_status, json.dumps({"error": "injected error"})
+
+        params = {key: values[0] for key, values in query.items()}
+        if route == "locations":
+            return 200, json.dumps(self._get_locations(params))
+        if route == "flights":
+            return 200, json.dumps(self._get_flights(params))
+        if route == "distancematrix":
+            return 200, json.dumps(self._get_distance_matrix(params))
+        return 200, json.dumps(self.gas_stations)
+
+    def _get_locations(self, params):
+        """ Replay the recorded airports within the requested box """
+        locations = [
+            location for location in self.locations
+            if float(params["low_lat"]) <= location["location"]["lat"] <= float(params["high_lat"]) and
+            float(params["low_lon"]) <= location["location"]["lon"] <= float(params["high_lon"])
+        ]
+        return {"locations": locations[:int(params.get("limit", 20))]}
+
+    def _get_flights(self, params):
+        """ Replay the recorded flights between the requested airports, spread over the requested dates """
+        origins = {airport.split(":")[-1] for airport in params["flyFrom"].split(",")}
+        destinations = {airport.split(":")[-1] for airport in params["to"].split(",")}
+        date_from = datetime.strptime(params["dateFrom"], "%d/%m/%Y")
+        num_days = (datetime.strptime(params.get("dateTo", params["dateFrom"]), "%d/%m/%Y") - date_from).days + 1
+
+        data = []
+        for i, flight in enumerate(self.flights):
+            if flight["flyFrom"] not in origins or flight["flyTo"] not in destinations:
+                continue
+            recorded_departure = datetime.utcfromtimestamp(flight["dTime"])
+            departure = date_from + timedelta(
+                days=i % max(1, num_days), hours=recorded_departure.hour, minutes=recorded_departure.minute)
+            data.append(dict(flight, dTime=int((departure - datetime(1970, 1, 1)).total_seconds())))
+
+        return {"data": data[:int(params.get("limit", len(data)))]}
+
+    def _get_distance_matrix(self, params):
+        """ Derive driving distances and durations from the straight-line distances between the coordinates """
+        origins = [tuple(map(float, location.split(","))) for location in params["origins"].split("|")]
+        destinations = [tuple(map(float, location.split(","))) for location in params["destinations"].split("|")]
+
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                meters = int(_get_haversine_distance_meters(*(origin + destination)) * DRIVING_DETOUR_FACTOR)
+                seconds = int(meters / DRIVING_SPEED_METERS_PER_SECOND)
+                elements.append({
+                    "distance": {"text": "{} km".format(meters // 1000), "value": meters},
+                    "duration": {"text": "{} hours {} mins".format(seconds // 3600, seconds % 3600 // 60),
+                                 "value": seconds},
+                    "status": "OK",
+                })
+            rows.append({"elements": elements})
+
+        return {"status": "OK", "rows": rows}
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles each request in a new thread """
+    daemon_threads = True
+
+
+def make_server(fake_upstream, host="127.0.0.1", port=0):
+    """
+    Create an HTTP server for a fake upstream
+    :param fake_upstream: FakeUpstream: the fake upstream to serve
+    :param host: string: host to listen on
+    :param port: int: port to listen on, 0 for any free port
+    :return: ThreadingHTTPServer: the server, not started yet
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            status, body = fake_upstream.handle(url.path, parse_qs(url.query))
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def get_upstream_routes(server):
+    """
+    Get the upstream API routes of a running server, as environment variables of the API
+    :param server: ThreadingHTTPServer: the server
+    :return: dict: environment variables pointing the API at the server
+    """
+    base_url = "http://{}:{}".format(*server.server_address[:2])
+    return {
+        "SKYPICKER_API_ROUTE": base_url + "/skypicker",
+        "GOOGLE_MAPS_API_ROUTE": base_url + "/maps/api",
+        "MYGASFEED_API_ROUTE_DEV": base_url + "/mygasfeed",
+    }
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Serve recorded upstream API responses locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    fake_upstream = FakeUpstream(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        error_status=args.error_status, seed=args.seed)
+    server = make_server(fake_upstream, host=args.host, port=args.port)
+    for name, value in sorted(get_upstream_routes(server).items()):
+        print("{}={}".format(name, value))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
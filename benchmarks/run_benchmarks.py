@@ -0,0 +1,278 @@
+"""
+Repeatable load benchmarks of finding and ranking travel options, against the local fake upstream.
+
+Each scenario sends a number of requests at a set concurrency, to either `analyze_travel_option` directly (`analyze`)
+or the falcon app served over HTTP (`app`), and reports the p50/p95/p99 latency, the throughput, the number of calls
+each upstream route received and the peak RSS of the process during the scenario, sampled from /proc on Linux, with
+its growth over the scenario. Caches are cleared before each scenario, and every request is a different trip, so
+scenarios are comparable between runs.
+
+Usage:
+    python -m benchmarks.run_benchmarks --targets analyze app --concurrency 1 4 16 --requests 40 --latency-ms 50
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server as make_wsgi_server
+
+import requests
+
+from benchmarks.fake_upstream import FakeUpstream
+from benchmarks.fake_upstream import get_upstream_routes
+from benchmarks.fake_upstream import make_server
+
+BASE_TRIP = {
+    "origin_lat": 37.6737957,
+    "origin_lon": -122.0795195,
+    "destination_lat": 34.0932502,
+    "destination_lon": -118.1165166,
+    "travel_date": "01/06/2019",
+}
+TRAVELER = {
+    "value_one_hour": 20,
+    "value_ten_hours": 150,
+}
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """ WSGI server that handles each request in a new thread """
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    """ WSGI request handler that does not log each request """
+    def log_message(self, format, *args):
+        pass
+
+
+def bound_request_body(application):
+    """
+    Wrap a WSGI application so that its request body stream ends at the request's Content-Length, as it does under
+    gunicorn, since wsgiref's stream blocks on reading past it
+    :param application: function: WSGI application
+    :return: function: the wrapped WSGI application
+    """
+    def bounded_application(environ, start_response):
+        content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        environ["wsgi.input"] = io.BytesIO(environ["wsgi.input"].read(content_length))
+        return application(environ, start_response)
+
+    return bounded_application
+
+
+def get_trip(i):
+    """
+    Get the parameters of the i-th trip of a scenario. Trips are spread far enough apart that they do not share cached
+    travel options or driving legs, but close enough that they share airports.
+    :param i: int: index of the trip
+    :return: dict: parameters of the trip
+    """
+    return dict(
+        BASE_TRIP,
+        origin_lat=BASE_TRIP["origin_lat"] + 0.01 * (i % 20),
+        origin_lon=BASE_TRIP["origin_lon"] + 0.01 * (i // 20),
+        destination_lat=BASE_TRIP["destination_lat"] - 0.01 * (i % 7),
+    )
+
+
+def get_percentile(sorted_values, percentile):
+    """ Nearest-rank percentile of a sorted list of values """
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(percentile / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def get_rss_mb():
+    """ Current resident set size of this process, in megabytes, or None where /proc is not available """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return resident_pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+def sample_peak_rss_mb(stop, samples, interval_seconds=0.05):
+    """
+    Sample the resident set size of this process until stopped. Unlike ru_maxrss, which is the peak of the whole
+    process so far, this gives the peak of a single scenario.
+    :param stop: threading.Event: set to stop sampling
+    :param samples: list: the samples (in megabytes) are appended to it
+    :param interval_seconds: float: time between two samples
+    """
+    while True:
+        rss_mb = get_rss_mb()
+        if rss_mb is None:
+            return
+        samples.append(rss_mb)
+        if stop.wait(interval_seconds):
+            return
+
+
+def clear_caches():
+    """ Clear every cache of the API, so that each scenario starts cold """
+    from trip_planner_api.air_travel import AIRPORT_CACHE
+    from trip_planner_api.air_travel import FLIGHT_CACHE
+    from trip_planner_api.plan_trip import TRAVEL_OPTIONS_CACHE
+    from trip_planner_api.plan_trip import TRAVEL_OPTIONS_VERSIONS
+    from trip_planner_api.util import DISTANCE_MATRIX_CACHE
+    from trip_planner_api.util import GAS_PRICE_CACHE
+
+    for cache in [AIRPORT_CACHE, FLIGHT_CACHE, TRAVEL_OPTIONS_CACHE, TRAVEL_OPTIONS_VERSIONS, DISTANCE_MATRIX_CACHE,
+                  GAS_PRICE_CACHE]:
+        cache.clear()
+
+
+def run_scenario(target, concurrency, num_requests, fake_upstream, app_url=None):
+    """
+    Send requests at a set concurrency, and measure them
+    :param target: string: "analyze" to call `analyze_travel_option`, or "app" to request the falcon app over HTTP
+    :param concurrency: int: number of requests in flight at the same time
+    :param num_requests: int: number of requests to send
+    :param fake_upstream: FakeUpstream: the fake upstream the API is pointed at
+    :param app_url: string: base URL of the served falcon app, needed for the "app" target
+    :return: dict: measurements of the scenario
+    """
+    from trip_planner_api.plan_trip import analyze_travel_option
+
+    sessions = threading.local()
+
+    def send(i):
+        start = time.time()
+        try:
+            if target == "analyze":
+                analyze_travel_option(get_trip(i), TRAVELER)
+            else:
+                if not hasattr(sessions, "session"):
+                    sessions.session = requests.Session()
+                body = dict(get_trip(i), is_debugging=False, **TRAVELER)
+                sessions.session.post(app_url + "/travel", json=body, timeout=300).raise_for_status()
+            is_error = False
+        except Exception:
+            is_error = True
+        return time.time() - start, is_error
+
+    clear_caches()
+    fake_upstream.handle("/_reset", {})
+    start_rss_mb = get_rss_mb()
+    rss_samples = []
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=sample_peak_rss_mb, args=(stop_sampling, rss_samples), daemon=True)
+    sampler.start()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, range(num_requests)))
+    elapsed = time.time() - start
+    stop_sampling.set()
+    sampler.join()
+    _, upstream_calls = fake_upstream.handle("/_stats", {})
+
+    peak_rss_mb = max(rss_samples) if rss_samples else None
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": num_requests,
+        "errors": sum(1 for _, is_error in outcomes if is_error),
+        "p50_seconds": get_percentile(latencies, 50),
+        "p95_seconds": get_percentile(latencies, 95),
+        "p99_seconds": get_percentile(latencies, 99),
+        "throughput_per_second": num_requests / elapsed,
+        "upstream_calls": json.loads(upstream_calls),
+        "peak_rss_mb": peak_rss_mb,
+        "rss_growth_mb": None if peak_rss_mb is None else peak_rss_mb - start_rss_mb,
+    }
+
+
+def format_megabytes(megabytes):
+    """ Format a size in megabytes for the report, which is not available on every platform """
+    return "n/a" if megabytes is None else "{:.1f}".format(megabytes)
+
+
+def format_result(result):
+    """ Format the measurements of a scenario as a line of the report """
+    return "{target:<8} {concurrency:>5} {requests:>6} {errors:>6} {p50:>8.3f} {p95:>8.3f} {p99:>8.3f} {rps:>8.2f} " \
+           "{rss:>8} {rss_growth:>8}  {calls}".format(
+               target=result["target"],
+               concurrency=result["concurrency"],
+               requests=result["requests"],
+               errors=result["errors"],
+               p50=result["p50_seconds"],
+               p95=result["p95_seconds"],
+               p99=result["p99_seconds"],
+               rps=result["throughput_per_second"],
+               rss=format_megabytes(result["peak_rss_mb"]),
+               rss_growth=format_megabytes(result["rss_growth_mb"]),
+               calls=" ".join("{}={}".format(k, v) for k, v in sorted(result["upstream_calls"].items())),
+           )
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Benchmark finding and ranking travel options")
+    parser.add_argument("--targets", nargs="+", choices=["analyze", "app"], default=["analyze", "app"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=40, help="number of requests of each scenario")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency of the fake upstream")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="random latency added on top of --latency-ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed upstream requests")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="path of a JSON file to write the results to")
+    parser.add_argument("--verbose", action="store_true", help="show the API's logs")
+    args = parser.parse_args()
+
+    fake_upstream = FakeUpstream(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate, seed=args.seed)
+    upstream_server = make_server(fake_upstream)
+    threading.Thread(target=upstream_server.serve_forever, daemon=True).start()
+
+    # The API reads its upstream routes from the environment, so they are set before it is imported
+    os.environ.update(get_upstream_routes(upstream_server))
+    os.environ.setdefault("ALLOWED_ORIGINS", '["http://localhost:3000"]')
+    # The upstream rate limits model the real APIs' quotas, so they are off against the fake upstream unless set
+    for upstream in ("SKYPICKER", "GOOGLE_MAPS", "MYGASFEED"):
+        os.environ.setdefault("{}_RATE_LIMIT_PER_SECOND".format(upstream), "0")
+    from trip_planner_api.app import application
+
+    app_url = None
+    if "app" in args.targets:
+        app_server = make_wsgi_server(
+            "127.0.0.1", 0, bound_request_body(application), server_class=ThreadingWSGIServer,
+            handler_class=QuietWSGIRequestHandler)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        app_url = "http://127.0.0.1:{}".format(app_server.server_address[1])
+
+    report = sys.stdout
+    print("{:<8} {:>5} {:>6} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        "target", "conc", "reqs", "errors", "p50 s", "p95 s", "p99 s", "req/s", "peak MB", "+MB", "upstream calls"),
+        file=report)
+
+    results = []
+    for target in args.targets:
+        for concurrency in args.concurrency:
+            with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+                result = run_scenario(target, concurrency, args.requests, fake_upstream, app_url=app_url)
+            results.append(result)
+            print(format_result(result), file=report)
+            report.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import pytest
+
+from trip_planner_api import rate_limit
+from trip_planner_api.metrics import PRIORITY_BATCH
+from trip_planner_api.metrics import PRIORITY_INTERACTIVE
+from trip_planner_api.rate_limit import RateLimitTimeoutError
+from trip_planner_api.rate_limit import SQLiteTokenBucket
+from trip_planner_api.rate_limit import TokenBucket
+from trip_planner_api.rate_limit import make_rate_limit
+
+
+class FakeClock(object):
+    """ Stands in for the time module, so that waiting for tokens takes no real time """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RecordingLogger(object):
+    """ Stands in for the module's logger, and keeps the warnings """
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, event, **kwargs):
+        self.warnings.append((event, kwargs))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", fake_clock)
+    return fake_clock
+
+
+def test_full_bucket_does_not_wait(clock):
+    bucket = TokenBucket("test", rate=10, burst=10)
+    assert bucket.acquire(cost=10, priority=PRIORITY_INTERACTIVE) == 0
+    assert bucket.stats()["waits"] == 0
+
+
+def test_refill_at_rate(clock):
+    bucket = TokenBucket("test", rate=10, burst=10)
+    bucket.acquire(cost=10, priority=PRIORITY_INTERACTIVE)
+    assert bucket.acquire(cost=5, priority=PRIORITY_INTERACTIVE) == pytest.approx(0.5)
+    assert bucket.stats()["waits"] == 1
+
+
+def test_refill_is_capped_at_burst(clock):
+    bucket = TokenBucket("test", rate=10, burst=10)
+    bucket.acquire(cost=10, priority=PRIORITY_INTERACTIVE)
+    clock.sleep(100)
+    assert bucket.acquire(cost=10, priority=PRIORITY_INTERACTIVE) == 0
+    assert bucket.acquire(cost=1, priority=PRIORITY_INTERACTIVE) == pytest.approx(0.1)
+
+
+def test_batch_leaves_reserve(clock):
+    bucket = TokenBucket("test", rate=10, burst=10, batch_reserve=0.2)
+    assert bucket.acquire(cost=8, priority=PRIORITY_BATCH) == 0
+    # 2 tokens are left, which batch calls must leave to interactive calls
+    assert bucket.acquire(cost=1, priority=PRIORITY_BATCH) == pytest.approx(0.1)
+    assert bucket.acquire(cost=1, priority=PRIORITY_INTERACTIVE) == 0
+
+
+def test_batch_holds_back_while_interactive_waits(clock):
+    bucket = TokenBucket("test", rate=10, burst=10, batch_reserve=0.2)
+    bucket.drain()
+    with pytest.raises(RateLimitTimeoutError):
+        bucket.acquire(cost=1, priority=PRIORITY_INTERACTIVE, max_wait_seconds=0)
+    # Without the waiting interactive call, the batch call would only wait for 3 tokens (0.3 seconds)
+    assert bucket.acquire(cost=1, priority=PRIORITY_BATCH) == pytest.approx(TokenBucket.INTERACTIVE_WAITING_SECONDS)
+
+
+def test_max_wait_timeout(clock):
+    bucket = TokenBucket("test", rate=1, burst=10)
+    bucket.drain()
+    start = clock.now
+    with pytest.raises(RateLimitTimeoutError):
+        bucket.acquire(cost=5, priority=PRIORITY_INTERACTIVE, max_wait_seconds=2)
+    assert clock.now - start <= 2
+    assert bucket.stats()["timeouts"] == 1
+
+
+def test_cost_is_capped_at_burst(clock):
+    bucket = TokenBucket("test", rate=1, burst=10)
+    assert bucket.acquire(cost=50, priority=PRIORITY_INTERACTIVE) == 0
+
+
+def test_drain_empties_bucket(clock):
+    bucket = TokenBucket("test", rate=10, burst=10)
+    bucket.drain()
+    assert bucket.acquire(cost=1, priority=PRIORITY_INTERACTIVE) == pytest.approx(0.1)
+
+
+def test_sqlite_bucket_is_shared(clock, tmp_path):
+    path = str(tmp_path / "rate_limits.sqlite3")
+    bucket = SQLiteTokenBucket("test", rate=10, burst=10, batch_reserve=0, path=path)
+    other_bucket = SQLiteTokenBucket("test", rate=10, burst=10, batch_reserve=0, path=path)
+    assert bucket.acquire(cost=10, priority=PRIORITY_INTERACTIVE) == 0
+    assert other_bucket.acquire(cost=5, priority=PRIORITY_INTERACTIVE) == pytest.approx(0.5)
+    other_bucket.drain()
+    assert bucket.acquire(cost=1, priority=PRIORITY_INTERACTIVE) == pytest.approx(0.1)
+
+
+def test_make_rate_limit_defaults_to_sqlite(monkeypatch, tmp_path):
+    monkeypatch.delenv("RATE_LIMIT_BACKEND", raising=False)
+    monkeypatch.setenv("RATE_LIMIT_SQLITE_PATH", str(tmp_path / "rate_limits.sqlite3"))
+    monkeypatch.setenv("TEST_RATE_LIMIT_PER_SECOND", "5")
+    assert isinstance(make_rate_limit("test", default_rate=1, default_burst=1), SQLiteTokenBucket)
+
+
+def test_make_rate_limit_off(monkeypatch):
+    monkeypatch.setenv("TEST_RATE_LIMIT_PER_SECOND", "0")
+    assert make_rate_limit("test", default_rate=1, default_burst=1) is None
+
+
+def test_memory_rate_limit_warns_with_several_workers(monkeypatch):
+    logger = RecordingLogger()
+    monkeypatch.setattr(rate_limit, "logger", logger)
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    bucket = make_rate_limit("test", default_rate=1, default_burst=1)
+    assert type(bucket) is TokenBucket
+    assert [kwargs["num_workers"] for _, kwargs in logger.warnings] == [4]
+
+    logger.warnings = []
+    monkeypatch.setenv("WEB_CONCURRENCY", "1")
+    make_rate_limit("test", default_rate=1, default_burst=1)
+    assert logger.warnings == []
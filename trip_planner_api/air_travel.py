@@ -1,48 +1,78 @@
+import heapq
+import math
 import os
-import requests
+import time
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from concurrent.futures import TimeoutError
+from concurrent.futures import as_completed
 
 import structlog
 
-import pandas as pd
-
+from trip_planner_api.airport_index import load_airport_index
+from trip_planner_api.cache import make_cache
+from trip_planner_api.metrics import RequestContextExecutor
+from trip_planner_api.metrics import span
+from trip_planner_api.options_analysis import get_equivalent_travel_cost
+from trip_planner_api.options_analysis import get_pareto_frontier
+from trip_planner_api.upstream import SKYPICKER
 from trip_planner_api.util import get_seconds_from_duration_string
 from trip_planner_api.util import get_duration_string_from_seconds
 from trip_planner_api.util import get_distance_string_from_meters
 from trip_planner_api.util import get_gas_cost
-from trip_planner_api.util import make_distance_matrix_request
+from trip_planner_api.util import get_gas_cost_per_liter
+from trip_planner_api.util import get_haversine_distance_meters
+from trip_planner_api.util import get_trip_driving_legs
 
 structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
+AIRPORT_CACHE = make_cache(
+    name="nearby_airports",
+    maxsize=int(os.getenv("AIRPORT_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("AIRPORT_CACHE_TTL_SECONDS", 86400)),
+)
 
-def _find_nearby_airports(latitude, longitude, limit=20):
+FLIGHT_CACHE = make_cache(
+    name="flights",
+    maxsize=int(os.getenv("FLIGHT_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("FLIGHT_CACHE_TTL_SECONDS", 600)),
+)
+
+AIRPORT_INDEX = load_airport_index(os.getenv("AIRPORTS_DATASET_PATH"))
+
+TIME_AT_AIRPORT_SECONDS = 5400
+
+
+def _search_airports_in_box(low_lat, high_lat, low_lon, high_lon, limit):
     """
-    Find the nearby airports of a given coordinate.
-    :param latitude: float: latitude of the location of interest
-    :param longitude: float: longitude of the location of interest
+    Search for the airports within a box of coordinates.
+    :param low_lat: float: southern edge of the box
+    :param high_lat: float: northern edge of the box
+    :param low_lon: float: western edge of the box
+    :param high_lon: float: eastern edge of the box
     :param limit: int: maximum number of airports to find
-    :return: dict: keys are airport three letter codes, and values are dictionaries of airport information
+    :return: dict: keys are airport three letter codes, and values are dictionaries of airport information, in the
+        order returned by Skypicker
     """
-    max_lat_diff = 0.5
-    max_lon_diff = 0.5
-
     url = "{route}/{resource}".format(
         route=os.getenv("SKYPICKER_API_ROUTE"),
         resource="locations",
     )
     params = {
         "type": "box",
-        "low_lat": latitude - max_lat_diff,
-        "high_lat": latitude + max_lat_diff,
-        "low_lon": longitude - max_lon_diff,
-        "high_lon": longitude + max_lon_diff,
+        "low_lat": low_lat,
+        "high_lat": high_lat,
+        "low_lon": low_lon,
+        "high_lon": high_lon,
         "locale": "en-US",
         "location_types": "airport",
         "limit": limit,
     }
-    r = requests.get(url=url, params=params).json()
+    r = SKYPICKER.get(url=url, params=params).json()
 
-    airports = {}
+    airports = OrderedDict()
     for location in r["locations"]:
         airports[location["code"]] = {
             "latitude": location["location"]["lat"],
@@ -52,144 +82,637 @@ def _find_nearby_airports(latitude, longitude, limit=20):
     return airports
 
 
-def _search_flights(origin, destination, date_from, date_to):
+def _find_nearby_airports(latitude, longitude, limit=20):
     """
-    Search for flights based on the origin and destination airports, and with in a certain date range.
-    :param origin: string: three letter code of the origin airport
-    :param destination: string: three letter code of the destination airport
+    Find the nearby airports of a given coordinate.
+    If a local airport dataset is loaded, the airports within AIRPORT_SEARCH_RADIUS_METERS are found in the local
+    index and ordered by distance. Otherwise, the airports around the grid cell containing the coordinate are looked
+    up through Skypicker once and cached, so that any later coordinate within the same cell is answered locally.
+    :param latitude: float: latitude of the location of interest
+    :param longitude: float: longitude of the location of interest
+    :param limit: int: maximum number of airports to find
+    :return: dict: keys are airport three letter codes, and values are dictionaries of airport information
+    """
+    if AIRPORT_INDEX is not None:
+        nearest = AIRPORT_INDEX.nearest(
+            latitude, longitude, k=limit,
+            max_distance_meters=float(os.getenv("AIRPORT_SEARCH_RADIUS_METERS", 75000)),
+        )
+        return OrderedDict((code, {"latitude": lat, "longitude": lon}) for _, code, lat, lon in nearest)
+
+    max_lat_diff = 0.5
+    max_lon_diff = 0.5
+    cell_size = float(os.getenv("AIRPORT_CACHE_CELL_DEGREES", 0.25))
+
+    cell = (math.floor(latitude / cell_size), math.floor(longitude / cell_size))
+    cell_airports = AIRPORT_CACHE.get(cell)
+    if cell_airports is None:
+        cell_airports = _search_airports_in_box(
+            low_lat=cell[0] * cell_size - max_lat_diff,
+            high_lat=(cell[0] + 1) * cell_size + max_lat_diff,
+            low_lon=cell[1] * cell_size - max_lon_diff,
+            high_lon=(cell[1] + 1) * cell_size + max_lon_diff,
+            limit=int(os.getenv("AIRPORT_CACHE_FETCH_LIMIT", 100)),
+        )
+        AIRPORT_CACHE.set(cell, cell_airports)
+        logger.info("nearby airports cache miss", cell=cell, **AIRPORT_CACHE.stats())
+
+    airports = {}
+    for code, info in cell_airports.items():
+        if len(airports) >= limit:
+            break
+        if abs(info["latitude"] - latitude) <= max_lat_diff and abs(info["longitude"] - longitude) <= max_lon_diff:
+            airports[code] = info
+
+    return airports
+
+
+def _prune_airports(latitude, longitude, airports, max_airports=None, max_radius_meters=None):
+    """
+    Keep only the airports closest to a given coordinate by straight-line distance.
+    :param latitude: float: latitude of the location of interest
+    :param longitude: float: longitude of the location of interest
+    :param airports: dict: keys are airport three letter codes, and values are dictionaries of airport information
+    :param max_airports: int: maximum number of airports to keep (defaults to MAX_AIRPORTS_PER_SIDE)
+    :param max_radius_meters: float: maximum distance of the airports to keep (defaults to MAX_AIRPORT_RADIUS_METERS,
+        no maximum if not set)
+    :return: dict: the kept airports, in the same format as `airports` and ordered by distance
+    """
+    if max_airports is None:
+        max_airports = int(os.getenv("MAX_AIRPORTS_PER_SIDE", 5))
+    if max_radius_meters is None and os.getenv("MAX_AIRPORT_RADIUS_METERS"):
+        max_radius_meters = float(os.getenv("MAX_AIRPORT_RADIUS_METERS"))
+
+    ranked = sorted(
+        (get_haversine_distance_meters(latitude, longitude, info["latitude"], info["longitude"]), code)
+        for code, info in airports.items()
+    )
+    if max_radius_meters is not None:
+        ranked = [(distance, code) for distance, code in ranked if distance <= max_radius_meters]
+
+    pruned = OrderedDict((code, airports[code]) for _, code in ranked[:max_airports])
+    logger.info("airports pruned", num_airports=len(airports), num_kept=len(pruned), kept=list(pruned))
+
+    return pruned
+
+
+def _split_flight_search(origins, destinations, date_from, date_to):
+    """
+    Split a flight search into two smaller searches: the larger side of airports in two halves, or else the date range
+    :return: list of tuples: (origins, destinations, date_from, date_to) of each search, or an empty list if a single
+        airport pair on a single date cannot be split
+    """
+    if len(origins) > 1 or len(destinations) > 1:
+        if len(origins) >= len(destinations):
+            middle = len(origins) // 2
+            return [(origins[:middle], destinations, date_from, date_to),
+                    (origins[middle:], destinations, date_from, date_to)]
+        middle = len(destinations) // 2
+        return [(origins, destinations[:middle], date_from, date_to),
+                (origins, destinations[middle:], date_from, date_to)]
+
+    first_date = datetime.strptime(date_from, "%d/%m/%Y")
+    num_days = (datetime.strptime(date_to, "%d/%m/%Y") - first_date).days
+    if num_days < 1:
+        return []
+    middle_date = first_date + timedelta(days=num_days // 2)
+    return [(origins, destinations, date_from, middle_date.strftime("%d/%m/%Y")),
+            (origins, destinations, (middle_date + timedelta(days=1)).strftime("%d/%m/%Y"), date_to)]
+
+
+def _search_flights(origins, destinations, date_from, date_to):
+    """
+    Search for flights between a set of origin airports and a set of destination airports, and within a certain date
+    range, using a single request. A response with FLIGHT_SEARCH_RESULT_LIMIT flights may be missing some, so the
+    search is then split into smaller searches.
+    :param origins: list of strings: three letter codes of the origin airports
+    :param destinations: list of strings: three letter codes of the destination airports
     :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
     :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
-    :return: dict: keys are trip IDs (multiple IDs separated with '|' if flight has stops), and values are dictionaries
-        of flight information.
+    :return: tuple: dict whose keys are (origin, destination) tuples of airport codes, and values are dictionaries
+        whose keys are trip IDs (multiple IDs separated with '|' if flight has stops), and values are dictionaries of
+        flight information; and set of the airport pairs whose flights are still truncated after splitting the search
     """
     url = "{route}/{resource}".format(
         route=os.getenv("SKYPICKER_API_ROUTE"),
         resource="flights",
     )
     params = {
-        "flyFrom": "airport:" + origin,
-        "to": "airport:" + destination,
+        "flyFrom": ",".join("airport:" + origin for origin in origins),
+        "to": ",".join("airport:" + destination for destination in destinations),
         "dateFrom": date_from,
         "dateTo": date_to,
         "partner": "picky",
+        "limit": int(os.getenv("FLIGHT_SEARCH_RESULT_LIMIT", 1000)),
     }
-    r = requests.get(url=url, params=params).json()
+    with span("flight_search", num_origins=len(origins), num_destinations=len(destinations)):
+        r = SKYPICKER.get(url=url, params=params).json()
 
-    flights = {}
+    if len(r["data"]) >= params["limit"]:
+        searches = _split_flight_search(origins, destinations, date_from, date_to)
+        logger.warning("flight search truncated", origins=origins, destinations=destinations, date_from=date_from,
+                       date_to=date_to, num_flights=len(r["data"]), num_split_searches=len(searches))
+        if searches:
+            flights = {}
+            truncated_pairs = set()
+            for search in searches:
+                search_flights, search_truncated_pairs = _search_flights(*search)
+                for airport_pair, pair_flights in search_flights.items():
+                    flights.setdefault(airport_pair, {}).update(pair_flights)
+                truncated_pairs.update(search_truncated_pairs)
+            return flights, truncated_pairs
+
+    flights = {(o, d): {} for o in origins for d in destinations}
     for flight in r["data"]:
-        flights[flight["id"]] = {
+        airport_pair = (flight["flyFrom"], flight["flyTo"])
+        if airport_pair not in flights:
+            continue
+
+        flights[airport_pair][flight["id"]] = {
             "price": flight["price"],
             "duration": flight["fly_duration"],
             "airlines": flight["airlines"],
             "routes": flight["routes"],
+            "departure_date": datetime.utcfromtimestamp(flight["dTime"]).strftime("%d/%m/%Y"),
         }
 
+    truncated_pairs = set(flights) if len(r["data"]) >= params["limit"] else set()
+    return flights, truncated_pairs
+
+
+def _chunk(items, size):
+    """ Split a list into consecutive chunks of at most `size` items """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _search_flight_batches(batches, date_from, date_to, max_workers=None, deadline=None, on_flights=None,
+                           on_failure=None):
+    """
+    Search for flights in batches of airports, each searched with a single request, with a bounded number of batches
+    searched at the same time.
+    :param batches: list of tuples: (origin airport codes, destination airport codes) of each batch
+    :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
+    :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
+    :param max_workers: int: maximum number of concurrent searches (defaults to FLIGHT_SEARCH_CONCURRENCY)
+    :param deadline: float: time (as given by time.time()) after which unfinished searches are abandoned
+    :param on_flights: function: called with the flights of each batch, in the same format as the returned dict, as
+        soon as the batch is searched
+    :param on_failure: function: called once with the list of airport pairs whose search failed or was abandoned, if
+        there are any
+    :return: dict: keys are (origin, destination) tuples of airport codes, and values are dictionaries of flights.
+        A failed or abandoned search results in empty dicts for its airport pairs so that the other airport pairs are
+        not affected. The flights of successful searches are cached in FLIGHT_CACHE, unless they are truncated.
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv("FLIGHT_SEARCH_CONCURRENCY", 8))
+
+    def no_flights(batch):
+        origin_batch, destination_batch = batch
+        return {(o, d): {} for o in origin_batch for d in destination_batch}
+
+    def search(batch):
+        origin_batch, destination_batch = batch
+        try:
+            batch_flights, truncated_pairs = _search_flights(
+                origins=origin_batch, destinations=destination_batch, date_from=date_from, date_to=date_to)
+            # The flights of pairs still truncated are used, but not cached as if they were complete
+            for (origin, destination), pair_flights in batch_flights.items():
+                if (origin, destination) not in truncated_pairs:
+                    FLIGHT_CACHE.set((origin, destination, date_from, date_to), pair_flights)
+            return batch_flights
+        except Exception as e:
+            logger.error("flight search error", origins=origin_batch, destinations=destination_batch, exception=e)
+            return None
+
+    executor = RequestContextExecutor(max_workers=max(1, max_workers))
+    futures = {executor.submit(search, batch): i for i, batch in enumerate(batches)}
+    timeout = None if deadline is None else max(0, deadline - time.time())
+
+    flights_by_batch = {}
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            flights_by_batch[futures[future]] = future.result()
+            if on_flights is not None and flights_by_batch[futures[future]] is not None:
+                on_flights(flights_by_batch[futures[future]])
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+        logger.warning("flight searches abandoned at the deadline", num_abandoned=len(batches) - len(flights_by_batch))
+    executor.shutdown(wait=False)
+
+    flights = {}
+    failed_pairs = []
+    for i, batch in enumerate(batches):
+        if flights_by_batch.get(i) is None:
+            failed_pairs.extend(no_flights(batch))
+        flights.update(flights_by_batch.get(i) or no_flights(batch))
+    if failed_pairs and on_failure is not None:
+        on_failure(failed_pairs)
+
+    logger.info("flight searches completed", num_requests=len(flights_by_batch), num_airport_pairs=len(flights))
+
     return flights
 
 
-def _get_airports_travel_info(latitude, longitude, airports, to_airports):
+def _get_flight_search_batches(airport_pairs, batch_size):
     """
-    Get the travel information of going to or from nearby airports
-    :param latitude: float: latitude of the location of interest
-    :param longitude: float: longitude of the location of interest
-    :param airports: dict: keys are airport three letter codes, and values are dictionaries of airport information
-    :param to_airports: boolean: True if getting travel information to airports, and False if from airports
-    :return: dict: keys are airport three letter codes, and values are dictionaries of travel information, including:
-        distance: int: distance in meters
-        duration: int: travel time in seconds
-    """
-    airport_codes = []
-    airport_locations = []
-    for code, info in airports.items():
-        airport_codes.append(code)
-        airport_locations.append("{},{}".format(info["latitude"], info["longitude"]))
-
-    if to_airports:
-        distances = make_distance_matrix_request(
-            origins="{},{}".format(latitude, longitude),
-            destinations="|".join(airport_locations),
-            origin_labels=["origin"],
-            destination_labels=airport_codes,
-            group_by_origins=True,
-        )
-        distances = distances["origin"]
-    else:
-        distances = make_distance_matrix_request(
-            origins="|".join(airport_locations),
-            destinations="{},{}".format(latitude, longitude),
-            origin_labels=airport_codes,
-            destination_labels=["destinations"],
-            group_by_origins=False,
-        )
-        distances = distances["destinations"]
+    Group airport pairs into batches of origin and destination airports that are each searched with a single request.
+    Origins are only batched together if they need the same destinations, so that no pair that is not asked for is
+    searched.
+    :param airport_pairs: list of tuples: (origin, destination) three letter codes of the airports
+    :param batch_size: int: maximum number of airports on each side of a batch
+    :return: list of tuples: (origin airport codes, destination airport codes) of each batch
+    """
+    destinations_by_origin = OrderedDict()
+    for origin, destination in airport_pairs:
+        destinations_by_origin.setdefault(origin, OrderedDict())[destination] = None
+
+    origins_by_destinations = OrderedDict()
+    for origin, destinations in destinations_by_origin.items():
+        origins_by_destinations.setdefault(tuple(destinations), []).append(origin)
 
-    return distances
+    return [
+        (origin_batch, destination_batch)
+        for destinations, origins in origins_by_destinations.items()
+        for origin_batch in _chunk(origins, batch_size)
+        for destination_batch in _chunk(list(destinations), batch_size)
+    ]
 
 
-def get_all_air_travel_options(origin_lat, origin_lon, destination_lat, destination_lon, travel_date):
+def _search_airport_pairs(airport_pairs, date_from, date_to, max_workers=None, batch_size=None, deadline=None,
+                          on_flights=None, on_failure=None):
+    """
+    Search for the flights of airport pairs, looking them up in FLIGHT_CACHE first. The uncached airport pairs are
+    split into batches that are each searched with a single request, and a bounded number of batches are searched at
+    the same time.
+    :param airport_pairs: list of tuples: (origin, destination) three letter codes of the airports
+    :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
+    :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
+    :param max_workers: int: maximum number of concurrent searches (defaults to FLIGHT_SEARCH_CONCURRENCY)
+    :param batch_size: int: maximum number of airports on each side of a search (defaults to FLIGHT_SEARCH_BATCH_SIZE),
+        1 searches every airport pair separately
+    :param deadline: float: time (as given by time.time()) after which unfinished searches are abandoned
+    :param on_flights: function: called with the cached flights, and with the flights of each batch as soon as the
+        batch is searched
+    :param on_failure: function: called with the airport pairs whose search failed or was abandoned, if there are any
+    :return: dict: keys are (origin, destination) tuples of airport codes, and values are dictionaries of flights
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("FLIGHT_SEARCH_BATCH_SIZE", 10))
+
+    cached_flights = {}
+    missing_pairs = []
+    for airport_pair in airport_pairs:
+        pair_flights = FLIGHT_CACHE.get(airport_pair + (date_from, date_to))
+        if pair_flights is None:
+            missing_pairs.append(airport_pair)
+        else:
+            cached_flights[airport_pair] = pair_flights
+
+    if cached_flights and on_flights is not None:
+        on_flights(cached_flights)
+
+    flights = {}
+    if missing_pairs:
+        batches = _get_flight_search_batches(missing_pairs, max(1, batch_size))
+        flights = _search_flight_batches(
+            batches, date_from, date_to, max_workers=max_workers, deadline=deadline, on_flights=on_flights,
+            on_failure=on_failure)
+    flights.update(cached_flights)
+
+    return flights
+
+
+def _search_flights_concurrently(origins, destinations, date_from, date_to, max_workers=None, batch_size=None,
+                                 deadline=None, on_flights=None, on_failure=None):
+    """
+    Search for flights between every origin and destination airport. The airports are split into batches that are
+    each searched with a single request, and a bounded number of batches are searched at the same time.
+    :param origins: list of strings: three letter codes of the origin airports
+    :param destinations: list of strings: three letter codes of the destination airports
+    :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
+    :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
+    :param max_workers: int: maximum number of concurrent searches (defaults to FLIGHT_SEARCH_CONCURRENCY)
+    :param batch_size: int: maximum number of airports on each side of a search (defaults to FLIGHT_SEARCH_BATCH_SIZE),
+        1 searches every airport pair separately
+    :param deadline: float: time (as given by time.time()) after which unfinished searches are abandoned
+    :param on_flights: function: called with the flights of each batch as soon as the batch is searched
+    :param on_failure: function: called with the airport pairs whose search failed or was abandoned, if there are any
+    :return: dict: keys are (origin, destination) tuples of airport codes, and values are dictionaries of flights
+    """
+    airport_pairs = [(origin, destination) for origin in origins for destination in destinations]
+
+    return _search_airport_pairs(
+        airport_pairs, date_from, date_to, max_workers=max_workers, batch_size=batch_size, deadline=deadline,
+        on_flights=on_flights, on_failure=on_failure)
+
+
+def _search_flights_best_first(airport_pairs, lower_bounds, get_costs, limit, date_from, date_to, known_costs=None,
+                               max_workers=None, batch_size=None, deadline=None, on_flights=None, on_failure=None):
+    """
+    Search for flights one wave of batches at a time, in order of the lowest possible equivalent travel cost of each
+    batch, and stop once no remaining batch can beat the `limit`-th best travel option found so far. The airport
+    pairs are batched as in `_search_airport_pairs`, so the best-first search never makes more requests than searching
+    every airport pair, and a trip whose airport pairs fit in one batch is searched with a single request.
+    :param airport_pairs: list of tuples: (origin, destination) three letter codes of the airports
+    :param lower_bounds: dict: keys are airport pairs, and values are lower bounds of the equivalent travel cost of any
+        travel option through the airport pair
+    :param get_costs: function: called with an airport pair after its flights are handled by `on_flights`, and returns
+        the equivalent travel costs of its travel options
+    :param limit: int: number of best travel options needed
+    :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
+    :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
+    :param known_costs: list of floats: equivalent travel costs of travel options found elsewhere (e.g. driving)
+    :param max_workers: int: number of batches searched in each wave (defaults to FLIGHT_SEARCH_CONCURRENCY)
+    :param batch_size: int: maximum number of airports on each side of a search (defaults to FLIGHT_SEARCH_BATCH_SIZE)
+    :param deadline: float: time (as given by time.time()) after which unfinished searches are abandoned
+    :param on_flights: function: called with the flights of each batch as soon as it is searched
+    :param on_failure: function: called with the airport pairs whose search failed or was abandoned, if there are any
+    :return: dict: keys are the searched (origin, destination) tuples of airport codes, and values are dictionaries of
+        flights
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv("FLIGHT_SEARCH_CONCURRENCY", 8))
+    max_workers = max(1, max_workers)
+    if batch_size is None:
+        batch_size = int(os.getenv("FLIGHT_SEARCH_BATCH_SIZE", 10))
+
+    best_costs = [-cost for cost in heapq.nsmallest(limit, known_costs or [])]
+    heapq.heapify(best_costs)
+
+    def get_batch_pairs(batch):
+        origin_batch, destination_batch = batch
+        return [(origin, destination) for origin in origin_batch for destination in destination_batch]
+
+    def get_batch_lower_bound(batch):
+        return min(lower_bounds[pair] for pair in get_batch_pairs(batch))
+
+    remaining = sorted(_get_flight_search_batches(airport_pairs, max(1, batch_size)), key=get_batch_lower_bound)
+    flights = {}
+    while remaining and (deadline is None or time.time() < deadline):
+        kth_best_cost = -best_costs[0] if len(best_costs) >= limit else float("inf")
+        wave = [batch for batch in remaining[:max_workers] if get_batch_lower_bound(batch) < kth_best_cost]
+        if not wave:
+            break
+        remaining = remaining[len(wave):]
+        wave_pairs = [pair for batch in wave for pair in get_batch_pairs(batch)]
+
+        flights.update(_search_airport_pairs(
+            wave_pairs, date_from, date_to, max_workers=max_workers, batch_size=batch_size, deadline=deadline,
+            on_flights=on_flights, on_failure=on_failure))
+
+        for pair in wave_pairs:
+            for cost in get_costs(pair):
+                if len(best_costs) < limit:
+                    heapq.heappush(best_costs, -cost)
+                elif cost < -best_costs[0]:
+                    heapq.heapreplace(best_costs, -cost)
+
+    if remaining and deadline is not None and time.time() >= deadline and on_failure is not None:
+        on_failure([pair for batch in remaining for pair in get_batch_pairs(batch)])
+
+    logger.info("best-first flight search finished", num_airport_pairs=len(airport_pairs),
+                num_searched=len(flights), num_skipped=sum(len(get_batch_pairs(batch)) for batch in remaining))
+
+    return flights
+
+
+def _get_flight_options(origin_airport, destination_airport, flights, travel_to_airport, travel_from_airport,
+                        gas_cost, frontier_only=False):
+    """
+    Build the air travel options of an airport pair
+    :param origin_airport: string: three letter code of the origin airport
+    :param destination_airport: string: three letter code of the destination airport
+    :param flights: dict: flights between the airports, as returned by `_search_flights`
+    :param travel_to_airport: dict: distance and duration of driving to the origin airport
+    :param travel_from_airport: dict: distance and duration of driving from the destination airport
+    :param gas_cost: float: gas cost of driving to and from the airports
+    :param frontier_only: boolean: if True, only the flights that no other flight of the pair beats on both price and
+        duration are built into travel options. The driving to and from the airports is the same for every flight of
+        the pair, so these are the pair's travel options that can be on the Pareto frontier of the trip.
+    :return: list of dicts: each dict is a travel option
+    """
+    duration_to_airport = travel_to_airport["duration"]["value"]
+    duration_from_airport = travel_from_airport["duration"]["value"]
+    total_driving_distance = travel_to_airport["distance"]["value"] + travel_from_airport["distance"]["value"]
+
+    logger.info("{} to {}: {} flights found".format(origin_airport, destination_airport, len(flights)))
+
+    flight_durations = [
+        (flight_info, get_seconds_from_duration_string(flight_info["duration"], "..h ..m"))
+        for flight_info in flights.values()
+    ]
+    if frontier_only:
+        flight_durations = get_pareto_frontier(
+            flight_durations, key=lambda flight_duration: (flight_duration[0]["price"], flight_duration[1]))
+
+    travel_options = []
+    for flight_info, duration in flight_durations:
+        duration += duration_to_airport + duration_from_airport
+
+        duration += TIME_AT_AIRPORT_SECONDS * 2
+
+        travel_options.append({
+            "origin_airport": origin_airport,
+            "destination_airport": destination_airport,
+            "travel_time": get_duration_string_from_seconds(duration, "{hours}h {minutes}m"),
+            "travel_time_seconds": duration,
+            "driving_distance": get_distance_string_from_meters(total_driving_distance, "{km} km"),
+            "driving_distance_meters": total_driving_distance,
+            "airlines": flight_info["airlines"],
+            "departure_date": flight_info["departure_date"],
+            "flight_cost": flight_info["price"],
+            "gas_cost": gas_cost,
+            "total_cost": flight_info["price"] + gas_cost,
+            "travel_method": "flight",
+        })
+
+    return travel_options
+
+
+def find_candidate_airports(origin_lat, origin_lon, destination_lat, destination_lon):
+    """
+    Find the airports to consider near the origin and near the destination
+    :param origin_lat: float: latitude of the origin
+    :param origin_lon: float: longitude of the origin
+    :param destination_lat: float: latitude of the destination
+    :param destination_lon: float: longitude of the destination
+    :return: tuple of dicts: origin airports and destination airports. Keys are airport three letter codes, and values
+        are dictionaries of airport information
+    """
+    origin_airports = _find_nearby_airports(latitude=origin_lat, longitude=origin_lon)
+    destination_airports = _find_nearby_airports(latitude=destination_lat, longitude=destination_lon)
+
+    origin_airports = _prune_airports(latitude=origin_lat, longitude=origin_lon, airports=origin_airports)
+    destination_airports = _prune_airports(
+        latitude=destination_lat, longitude=destination_lon, airports=destination_airports)
+
+    return origin_airports, destination_airports
+
+
+def prefetch_nearby_airports(locations):
+    """
+    Look up the nearby airports of many locations ahead of time, so that later lookups are answered locally. Locations
+    within the same grid cell share a single lookup.
+    :param locations: list of tuples: (latitude, longitude) of the locations
+    """
+    if AIRPORT_INDEX is not None:
+        return
+
+    cell_size = float(os.getenv("AIRPORT_CACHE_CELL_DEGREES", 0.25))
+    locations_by_cell = OrderedDict()
+    for latitude, longitude in locations:
+        locations_by_cell.setdefault((math.floor(latitude / cell_size), math.floor(longitude / cell_size)),
+                                     (latitude, longitude))
+
+    missing = [location for cell, location in locations_by_cell.items() if cell not in AIRPORT_CACHE]
+    logger.info("prefetching nearby airports", num_locations=len(locations), num_cells=len(locations_by_cell),
+                num_missing=len(missing))
+    if not missing:
+        return
+
+    max_workers = int(os.getenv("FLIGHT_SEARCH_CONCURRENCY", 8))
+    with RequestContextExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+        list(executor.map(lambda location: _find_nearby_airports(*location), missing))
+
+
+def prefetch_flights(airport_pairs, date_from, date_to, deadline=None):
+    """
+    Search for the flights of many airport pairs ahead of time, so that later searches of the same pairs and dates
+    are answered from FLIGHT_CACHE. Each distinct airport pair is searched once, batched with the other pairs.
+    :param airport_pairs: list of tuples: (origin, destination) three letter codes of the airports
+    :param date_from: string ("dd/mm/yyyy"): departure date to begin searching from
+    :param date_to: string ("dd/mm/yyyy"): departure date to stop searching at
+    :param deadline: float: time (as given by time.time()) after which unfinished searches are abandoned
+    """
+    airport_pairs = list(OrderedDict.fromkeys(airport_pairs))
+    logger.info("prefetching flights", num_airport_pairs=len(airport_pairs), date_from=date_from, date_to=date_to)
+    _search_airport_pairs(airport_pairs, date_from, date_to, deadline=deadline)
+
+
+def get_all_air_travel_options(origin_lat, origin_lon, destination_lat, destination_lon, travel_date,
+                               origin_airports=None, destination_airports=None, driving_legs=None,
+                               gas_cost_per_liter=None, deadline=None, on_options=None, traveler_params=None,
+                               limit=None, known_costs=None, travel_date_to=None, frontier_only=False,
+                               on_failure=None):
     """
     Get all of the air travel options and the detailed information about the options
     :param origin_lat: float: latitude of the origin
     :param origin_lon: float: longitude of the origin
     :param destination_lat: float: latitude of the destination
     :param destination_lon: float: longitude of the destination
-    :param travel_date: string ("dd/mm/yyyy"): departure date to search flights on
-    :return: pandas.DataFrame: each row is a travel option, and each column is some information about the travel option
+    :param travel_date: string ("dd/mm/yyyy"): departure date to search flights on, or the first departure date if
+        `travel_date_to` is given
+    :param origin_airports: dict: airports near the origin, found with `find_candidate_airports` if not given
+    :param destination_airports: dict: airports near the destination, found with `find_candidate_airports` if not given
+    :param driving_legs: dict: driving legs of the trip from `get_trip_driving_legs`, resolved here if not given
+    :param gas_cost_per_liter: float: gas cost per liter near the origin, looked up here if not given
+    :param deadline: float: time (as given by time.time()) after which unfinished flight searches are abandoned
+    :param on_options: function: called with the list of travel options of each airport pair as soon as its flights
+        are found
+    :param traveler_params: dict: the traveler's `value_one_hour` and `value_ten_hours`, needed with `limit`
+    :param limit: int: if given, airport pairs that cannot contain one of the `limit` best travel options are not
+        searched, so only the best travel options are guaranteed to be returned
+    :param known_costs: list of floats: equivalent travel costs of travel options found elsewhere (e.g. driving),
+        used with `limit`
+    :param travel_date_to: string ("dd/mm/yyyy"): if given, flights departing on any date from `travel_date` to this
+        date are searched with the same requests
+    :param frontier_only: boolean: if True, flights beaten on both price and duration by another flight of the same
+        airport pair are discarded as soon as the pair's flights arrive, so only candidates for the Pareto frontier of
+        the trip are returned
+    :param on_failure: function: called with the airport pairs whose flights could not be searched (the search
+        failed, or was abandoned at the deadline), whose travel options are then missing
+    :return: list of dicts: each dict is a travel option, and each key is some information about the travel option
     """
     logger.info("getting all air travel options")
 
-    origin_airports = _find_nearby_airports(latitude=origin_lat, longitude=origin_lon)
-    destination_airports = _find_nearby_airports(latitude=destination_lat, longitude=destination_lon)
+    if origin_airports is None or destination_airports is None:
+        origin_airports, destination_airports = find_candidate_airports(
+            origin_lat, origin_lon, destination_lat, destination_lon)
 
-    travel_to_airports = _get_airports_travel_info(
-        latitude=origin_lat, longitude=origin_lon,
-        airports=origin_airports, to_airports=True)
-    travel_from_airports = _get_airports_travel_info(
-        latitude=destination_lat, longitude=destination_lon,
-        airports=destination_airports, to_airports=False)
+    if driving_legs is None:
+        driving_legs = get_trip_driving_legs(
+            origin_lat, origin_lon, destination_lat, destination_lon, origin_airports, destination_airports)
+    travel_to_airports = driving_legs["to_airports"]
+    travel_from_airports = driving_legs["from_airports"]
 
-    travel_options = []
-    for origin_airport in origin_airports:
-        for destination_airport in destination_airports:
-            duration_to_airport = travel_to_airports[origin_airport]["duration"]["value"]
-            duration_from_airport = travel_from_airports[destination_airport]["duration"]["value"]
+    if gas_cost_per_liter is None:
+        gas_cost_per_liter = get_gas_cost_per_liter(latitude=origin_lat, longitude=origin_lon)
 
-            distance_to_airport = travel_to_airports[origin_airport]["distance"]["value"]
-            distance_from_airport = travel_from_airports[destination_airport]["distance"]["value"]
-            total_driving_distance = distance_to_airport + distance_from_airport
+    options_by_pair = {}
+
+    def add_flight_options(flights):
+        """ Build the travel options of the airport pairs of a searched batch as soon as it arrives """
+        for (origin_airport, destination_airport), pair_flights in flights.items():
+            travel_to_airport = travel_to_airports[origin_airport]
+            travel_from_airport = travel_from_airports[destination_airport]
             gas_cost = get_gas_cost(
-                distance_meters=total_driving_distance,
+                distance_meters=travel_to_airport["distance"]["value"] + travel_from_airport["distance"]["value"],
                 latitude=origin_lat,
                 longitude=origin_lon,
+                cost_per_liter=gas_cost_per_liter,
             )
+            options = _get_flight_options(
+                origin_airport, destination_airport, pair_flights, travel_to_airport, travel_from_airport, gas_cost,
+                frontier_only=frontier_only)
+            options_by_pair[(origin_airport, destination_airport)] = options
+            if on_options is not None and options:
+                on_options(options)
+
+    airport_pairs = [(o, d) for o in origin_airports for d in destination_airports]
+    value_one_hour = traveler_params["value_one_hour"] if traveler_params else None
+    value_ten_hours = traveler_params["value_ten_hours"] if traveler_params else None
 
-            flights = _search_flights(
-                origin=origin_airport,
-                destination=destination_airport,
-                date_from=travel_date,
-                date_to=travel_date,
+    # The lower bounds assume the time value grows with the travel time, which holds when 10 hours are worth more
+    if limit is not None and traveler_params is not None and value_ten_hours >= value_one_hour:
+        lower_bounds = {}
+        for origin_airport, destination_airport in airport_pairs:
+            travel_to_airport = travel_to_airports[origin_airport]
+            travel_from_airport = travel_from_airports[destination_airport]
+            gas_cost = get_gas_cost(
+                distance_meters=travel_to_airport["distance"]["value"] + travel_from_airport["distance"]["value"],
+                latitude=origin_lat,
+                longitude=origin_lon,
+                cost_per_liter=gas_cost_per_liter,
             )
-            logger.info("{} to {}: {} flights found".format(origin_airport, destination_airport, len(flights)))
-
-            for flight_ids, flight_info in flights.items():
-                duration = get_seconds_from_duration_string(flight_info["duration"], "..h ..m")
-                duration += duration_to_airport + duration_from_airport
-
-                time_at_airport = 5400
-                duration += time_at_airport * 2
-
-                travel_options.append({
-                    "origin_airport": origin_airport,
-                    "destination_airport": destination_airport,
-                    "travel_time": get_duration_string_from_seconds(duration, "{hours}h {minutes}m"),
-                    "travel_time_seconds": duration,
-                    "driving_distance": get_distance_string_from_meters(total_driving_distance, "{km} km"),
-                    "driving_distance_meters": total_driving_distance,
-                    "airlines": flight_info["airlines"],
-                    "flight_cost": flight_info["price"],
-                    "gas_cost": gas_cost,
-                    "total_cost": flight_info["price"] + gas_cost,
-                    "travel_method": "flight",
-                })
-
-    return pd.DataFrame(travel_options)
+            min_duration = (travel_to_airport["duration"]["value"] + travel_from_airport["duration"]["value"] +
+                            TIME_AT_AIRPORT_SECONDS * 2)
+            lower_bounds[(origin_airport, destination_airport)] = get_equivalent_travel_cost(
+                gas_cost, min_duration, value_one_hour, value_ten_hours)
+
+        def get_costs(airport_pair):
+            return [
+                get_equivalent_travel_cost(
+                    option["total_cost"], option["travel_time_seconds"], value_one_hour, value_ten_hours)
+                for option in options_by_pair.get(airport_pair, [])
+            ]
+
+        _search_flights_best_first(
+            airport_pairs=airport_pairs,
+            lower_bounds=lower_bounds,
+            get_costs=get_costs,
+            limit=limit,
+            date_from=travel_date,
+            date_to=travel_date_to or travel_date,
+            known_costs=known_costs,
+            deadline=deadline,
+            on_flights=add_flight_options,
+            on_failure=on_failure,
+        )
+    else:
+        _search_flights_concurrently(
+            origins=list(origin_airports),
+            destinations=list(destination_airports),
+            date_from=travel_date,
+            date_to=travel_date_to or travel_date,
+            deadline=deadline,
+            on_flights=add_flight_options,
+            on_failure=on_failure,
+        )
+
+    travel_options = []
+    for origin_airport in origin_airports:
+        for destination_airport in destination_airports:
+            travel_options.extend(options_by_pair.get((origin_airport, destination_airport), []))
+
+    return travel_options
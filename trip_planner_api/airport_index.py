@@ -0,0 +1,112 @@
+import csv
+import math
+from collections import OrderedDict
+
+import structlog
+
+from trip_planner_api.util import get_haversine_distance_meters
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+METERS_PER_DEGREE_LATITUDE = 111195
+
+
+class AirportIndex(object):
+    """ Uniform grid spatial index of airport locations """
+    def __init__(self, airports, cell_size=1.0):
+        """
+        :param airports: dict: keys are airport three letter codes, and values are dictionaries of airport information
+        :param cell_size: float: size of each grid cell in degrees
+        """
+        self.cell_size = cell_size
+        self.num_lon_cells = int(math.ceil(360 / cell_size))
+        self._cells = {}
+        for code, info in airports.items():
+            cell = self._get_cell(info["latitude"], info["longitude"])
+            self._cells.setdefault(cell, []).append((code, info["latitude"], info["longitude"]))
+        self.size = len(airports)
+
+    def _get_cell(self, latitude, longitude):
+        """ Get the grid cell containing a coordinate """
+        return (
+            int(math.floor(latitude / self.cell_size)),
+            int(math.floor((longitude + 180) / self.cell_size)) % self.num_lon_cells,
+        )
+
+    def within_radius(self, latitude, longitude, radius_meters):
+        """
+        Find the airports within a certain distance of a coordinate.
+        :param latitude: float: latitude of the location of interest
+        :param longitude: float: longitude of the location of interest
+        :param radius_meters: float: maximum distance in meters
+        :return: list of tuples: (distance in meters, code, latitude, longitude) of the airports, ordered by distance
+        """
+        lat_diff = radius_meters / METERS_PER_DEGREE_LATITUDE
+        cos_lat = math.cos(math.radians(min(89.9, abs(latitude) + lat_diff)))
+        lon_diff = min(180.0, lat_diff / max(cos_lat, 1e-6))
+
+        low_lat_cell, low_lon_cell = self._get_cell(latitude - lat_diff, longitude - lon_diff)
+        high_lat_cell, _ = self._get_cell(latitude + lat_diff, longitude)
+        num_lon_cells = min(self.num_lon_cells, int(math.ceil(2 * lon_diff / self.cell_size)) + 1)
+
+        found = []
+        for lat_cell in range(low_lat_cell, high_lat_cell + 1):
+            for i in range(num_lon_cells):
+                lon_cell = (low_lon_cell + i) % self.num_lon_cells
+                for code, lat, lon in self._cells.get((lat_cell, lon_cell), []):
+                    distance = get_haversine_distance_meters(latitude, longitude, lat, lon)
+                    if distance <= radius_meters:
+                        found.append((distance, code, lat, lon))
+
+        found.sort()
+        return found
+
+    def nearest(self, latitude, longitude, k, max_distance_meters=None):
+        """
+        Find the airports nearest to a coordinate.
+        :param latitude: float: latitude of the location of interest
+        :param longitude: float: longitude of the location of interest
+        :param k: int: maximum number of airports to find
+        :param max_distance_meters: float: if given, only airports within this distance are returned
+        :return: list of tuples: (distance in meters, code, latitude, longitude) of the airports, ordered by distance
+        """
+        if max_distance_meters is not None:
+            return self.within_radius(latitude, longitude, max_distance_meters)[:k]
+
+        # Widen the search until it contains k airports, which are then guaranteed to be the k nearest ones
+        half_circumference = math.pi * 6371008.8
+        radius = self.cell_size * METERS_PER_DEGREE_LATITUDE
+        while True:
+            found = self.within_radius(latitude, longitude, radius)
+            if len(found) >= k or radius >= half_circumference:
+                return found[:k]
+            radius *= 2
+
+
+def load_airport_index(path, cell_size=1.0):
+    """
+    Load a local airport dataset into a spatial index.
+    The dataset is a CSV file in the OurAirports `airports.csv` format. Only airports with an IATA code are indexed,
+    and airports without scheduled service are skipped if the dataset has a `scheduled_service` column.
+    :param path: string: path of the CSV file, or None if no local dataset is used
+    :param cell_size: float: size of each grid cell in degrees
+    :return: AirportIndex: index of the airports, or None if no path is given
+    """
+    if not path:
+        return None
+
+    airports = OrderedDict()
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            code = (row.get("iata_code") or "").strip()
+            if not code or row.get("scheduled_service", "yes") != "yes":
+                continue
+            airports[code] = {
+                "latitude": float(row["latitude_deg"]),
+                "longitude": float(row["longitude_deg"]),
+            }
+
+    logger.info("local airport dataset loaded", path=path, num_airports=len(airports))
+
+    return AirportIndex(airports, cell_size=cell_size)
@@ -1,17 +1,50 @@
+import os
+
 import falcon
 
 from .controllers.health import HealthCheck
+from .controllers.metrics import Metrics
 from .controllers.travel import TravelOptions
+from .controllers.travel import TravelOptionsBatch
+from .controllers.travel import TravelOptionsBatchJob
+from .controllers.travel import TravelOptionsJob
+from .controllers.travel import TravelOptionsRerank
+from .jobs import JobStore
 from .middleware.handle_cors import HandleCORS
+from .middleware.request_context import RequestContext
 
 api = application = falcon.API(
     middleware=[
-        HandleCORS()
+        RequestContext(),
+        HandleCORS(),
     ]
 )
 
+travel_jobs = JobStore(
+    max_jobs=int(os.getenv("TRAVEL_JOBS_MAX", 100)),
+    ttl=float(os.getenv("TRAVEL_JOBS_TTL_SECONDS", 600)),
+    max_workers=int(os.getenv("TRAVEL_JOBS_WORKERS", 4)),
+    name="travel_jobs",
+)
+travel_batch_jobs = JobStore(
+    max_jobs=int(os.getenv("TRAVEL_BATCH_JOBS_MAX", 10)),
+    ttl=float(os.getenv("TRAVEL_JOBS_TTL_SECONDS", 600)),
+    max_workers=int(os.getenv("TRAVEL_BATCH_JOBS_WORKERS", 1)),
+    name="travel_batch_jobs",
+)
+
 health = HealthCheck()
-travel = TravelOptions()
+metrics = Metrics()
+travel = TravelOptions(travel_jobs)
+travel_job = TravelOptionsJob(travel_jobs)
+travel_rerank = TravelOptionsRerank()
+travel_batch = TravelOptionsBatch(travel_batch_jobs)
+travel_batch_job = TravelOptionsBatchJob(travel_batch_jobs)
 
 api.add_route("/health", health)
+api.add_route("/metrics", metrics)
 api.add_route("/travel", travel)
+api.add_route("/travel/rerank", travel_rerank)
+api.add_route("/travel/batch", travel_batch)
+api.add_route("/travel/batch/{job_id}", travel_batch_job)
+api.add_route("/travel/{job_id}", travel_job)
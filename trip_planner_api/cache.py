@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import structlog
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+
+class TTLCache(object):
+    """ Thread-safe in-memory cache with a time-to-live on each entry and least-recently-used eviction """
+    def __init__(self, name, maxsize, ttl):
+        """
+        :param name: string: name of the cache, used when reporting statistics
+        :param maxsize: int: maximum number of entries to keep
+        :param ttl: float: default number of seconds an entry stays valid
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, counting the lookup as a hit or a miss
+        :param key: hashable: key of the entry
+        :param default: value returned if the entry is missing or expired
+        :return: the cached value, or `default`
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        """ Check whether an unexpired entry exists, without counting the lookup as a hit or a miss """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] >= time.time()
+
+    def set(self, key, value, ttl=None):
+        """
+        Store an entry, evicting the least recently used entries if the cache is full
+        :param key: hashable: key of the entry
+        :param value: value to store
+        :param ttl: float: number of seconds the entry stays valid, defaults to the cache's ttl
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove all entries and reset the statistics """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Report the usage of the cache
+        :return: dict: name, size, maxsize, hits and misses of the cache
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class SQLiteCache(object):
+    """
+    Cache with a time-to-live on each entry, stored in a SQLite database file so that it is shared by every process on
+    the host. Values are stored as JSON. Writes are atomic, and the size limit is enforced every few writes by evicting
+    the entries closest to expiring. Errors are logged and treated as misses, so that a busy or broken database only
+    costs upstream calls.
+    """
+    PRUNE_INTERVAL = 64
+
+    def __init__(self, name, maxsize, ttl, path):
+        """
+        :param name: string: name of the cache, used as its table name and when reporting statistics
+        :param maxsize: int: maximum number of entries to keep
+        :param ttl: float: default number of seconds an entry stays valid
+        :param path: string: path of the SQLite database file
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._num_writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                .format(self.name))
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_expires_at ON {0} (expires_at)".format(self.name))
+
+    def _connect(self):
+        """ Get this thread's connection to the database, reconnecting in a forked worker process """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=float(os.getenv("CACHE_SQLITE_TIMEOUT_SECONDS", 5)))
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, is_hit):
+        """ Count a lookup as a hit or a miss """
+        with self._lock:
+            if is_hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, counting the lookup as a hit or a miss
+        :param key: hashable: key of the entry, identified by its repr
+        :param default: value returned if the entry is missing or expired
+        :return: the cached value, or `default`
+        """
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM {} WHERE key = ? AND expires_at >= ?".format(self.name),
+                (repr(key), time.time())).fetchone()
+            value = None if row is None else json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning("cache read error", cache=self.name, exception=e)
+            row = None
+
+        self._count(is_hit=row is not None)
+        return default if row is None else value
+
+    def __contains__(self, key):
+        """ Check whether an unexpired entry exists, without counting the lookup as a hit or a miss """
+        try:
+            return self._connect().execute(
+                "SELECT 1 FROM {} WHERE key = ? AND expires_at >= ?".format(self.name),
+                (repr(key), time.time())).fetchone() is not None
+        except sqlite3.Error as e:
+            logger.warning("cache read error", cache=self.name, exception=e)
+            return False
+
+    def set(self, key, value, ttl=None):
+        """
+        Store an entry, replacing any entry with the same key
+        :param key: hashable: key of the entry, identified by its repr
+        :param value: JSON serializable value to store, whose tuples are read back as lists
+        :param ttl: float: number of seconds the entry stays valid, defaults to the cache's ttl
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._num_writes += 1
+            is_prune_due = self._num_writes % self.PRUNE_INTERVAL == 0
+
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO {} (key, value, expires_at) VALUES (?, ?, ?)".format(self.name),
+                    (repr(key), json.dumps(value), expires_at))
+            if is_prune_due:
+                self._prune()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning("cache write error", cache=self.name, exception=e)
+
+    def _prune(self):
+        """ Remove the expired entries, and then the entries closest to expiring while the cache is too large """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM {} WHERE expires_at < ?".format(self.name), (time.time(),))
+            connection.execute(
+                "DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY expires_at LIMIT MAX(0, "
+                "(SELECT COUNT(*) FROM {0}) - ?))".format(self.name), (self.maxsize,))
+
+    def clear(self):
+        """ Remove all entries and reset the statistics """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM {}".format(self.name))
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Report the usage of the cache. Hits and misses are counted by this process only.
+        :return: dict: name, size, maxsize, hits and misses of the cache
+        """
+        try:
+            size = self._connect().execute("SELECT COUNT(*) FROM {}".format(self.name)).fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def get_sqlite_path(env_var, filename):
+    """
+    Get the path of a SQLite database file shared by the worker processes: the path set by `env_var`, or else
+    `filename` in a directory private to the user within the temporary directory. The directory must belong to the user
+    (or root) and not be writable by anyone else, so that another local user cannot plant or alter the database.
+    :param env_var: string: name of the environment variable that sets the path
+    :param filename: string: name of the file in the default directory
+    :return: string: path of the database file, which is created if needed
+    """
+    path = os.getenv(env_var)
+    if not path:
+        directory = os.path.join(tempfile.gettempdir(), "trip_planner-{}".format(os.getuid()))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        path = os.path.join(directory, filename)
+
+    def check_private(checked_path, owners):
+        status = os.stat(checked_path)
+        if status.st_uid not in owners or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError("{} must be owned by the user and only writable by it ({})".format(checked_path, env_var))
+
+    check_private(os.path.dirname(os.path.abspath(path)), (os.getuid(), 0))
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    check_private(path, (os.getuid(),))
+
+    return path
+
+
+def make_cache(name, maxsize, ttl):
+    """
+    Create a cache with the backend set by CACHE_BACKEND: "memory" (the default) for a TTLCache private to the process,
+    or "sqlite" for a SQLiteCache in CACHE_SQLITE_PATH (see `get_sqlite_path`) shared by every worker process on the
+    host
+    :param name: string: name of the cache
+    :param maxsize: int: maximum number of entries to keep
+    :param ttl: float: default number of seconds an entry stays valid
+    :return: TTLCache or SQLiteCache: the cache
+    """
+    backend = os.getenv("CACHE_BACKEND", "memory")
+    if backend == "sqlite":
+        path = get_sqlite_path("CACHE_SQLITE_PATH", "cache.sqlite3")
+        return SQLiteCache(name=name, maxsize=maxsize, ttl=ttl, path=path)
+    if backend != "memory":
+        raise ValueError("unsupported cache backend: {}".format(backend))
+    return TTLCache(name=name, maxsize=maxsize, ttl=ttl)
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls with the same key, so that only one of them runs and the others share its result """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Call a function, unless a call with the same key is already running, in which case wait for its result
+        :param key: hashable: key of the call
+        :param fn: function: called without arguments
+        :return: tuple: the result of the call, and True if the result was shared from another caller's call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_shared = call is not None
+            if not is_shared:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if is_shared:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = fn()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], is_shared
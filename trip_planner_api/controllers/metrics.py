@@ -0,0 +1,37 @@
+from trip_planner_api.metrics import HISTOGRAMS
+from trip_planner_api.upstream import UPSTREAMS
+
+UPSTREAM_COUNTERS = [
+    ("requests", "trip_planner_upstream_requests_total", "Number of requests made to each upstream API"),
+    ("errors", "trip_planner_upstream_errors_total", "Number of failed requests to each upstream API"),
+    ("retries", "trip_planner_upstream_retries_total", "Number of retried requests to each upstream API"),
+    ("rejected", "trip_planner_upstream_rejected_total", "Number of calls rejected by each open circuit breaker"),
+    ("rate_limit_waits", "trip_planner_upstream_rate_limit_waits_total",
+     "Number of requests to each upstream API that waited for its rate limit"),
+    ("rate_limit_timeouts", "trip_planner_upstream_rate_limit_timeouts_total",
+     "Number of calls to each upstream API that gave up waiting for its rate limit"),
+]
+
+
+class Metrics(object):
+    """ Metrics resource, in the Prometheus text format. Each worker process reports its own metrics. """
+    def on_get(self, req, resp):
+        lines = []
+        for histogram in HISTOGRAMS:
+            lines.extend(histogram.render())
+
+        upstream_stats = [upstream.stats() for upstream in UPSTREAMS]
+        for key, name, description in UPSTREAM_COUNTERS:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} counter".format(name))
+            for stats in upstream_stats:
+                lines.append('{}{{upstream="{}"}} {}'.format(name, stats["name"], stats[key]))
+
+        lines.append("# HELP trip_planner_upstream_circuit_open Whether each upstream API's circuit breaker is open")
+        lines.append("# TYPE trip_planner_upstream_circuit_open gauge")
+        for stats in upstream_stats:
+            lines.append('trip_planner_upstream_circuit_open{{upstream="{}"}} {}'.format(
+                stats["name"], int(stats["circuit_open"])))
+
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.body = "\n".join(lines) + "\n"
@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import falcon
+import simplejson
+
+# Supported content codings, in order of preference when a client accepts several of them equally
+COMPRESSORS = OrderedDict([
+    ("gzip", lambda data, level: gzip.compress(data, compresslevel=level)),
+    ("deflate", lambda data, level: zlib.compress(data, level)),
+])
+
+
+def _get_accepted_encoding(accept_encoding):
+    """
+    Choose the content coding to compress a response with
+    :param accept_encoding: string: value of the request's Accept-Encoding header
+    :return: string: a content coding of COMPRESSORS, or None to not compress the response
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[parts[0].strip().lower()] = quality
+
+    chosen_encoding, chosen_quality = None, 0.0
+    for encoding in COMPRESSORS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > chosen_quality:
+            chosen_encoding, chosen_quality = encoding, quality
+
+    return chosen_encoding
+
+
+def _matches_etag(if_none_match, etag):
+    """
+    Check whether an If-None-Match header matches an ETag, using the weak comparison
+    :param if_none_match: string: value of the request's If-None-Match header
+    :param etag: string: ETag of the response
+    :return: boolean: True if the client already has the response
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def strip_weak(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return strip_weak(etag) in {strip_weak(tag) for tag in if_none_match.split(",")}
+
+
+class ResponseBody(object):
+    """
+    Serialized response body with its ETag. Its compressed encodings are computed the first time they are needed and
+    kept, so a response body that is sent many times is serialized and compressed only once.
+    """
+    def __init__(self, data, content_type=falcon.MEDIA_JSON):
+        """
+        :param data: bytes: the serialized body
+        :param content_type: string: media type of the body
+        """
+        self.data = data
+        self.content_type = content_type
+        self.etag = 'W/"{}"'.format(hashlib.sha1(data).hexdigest())
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, doc):
+        """
+        Serialize a JSON document, with NaN values as null
+        :param doc: JSON serializable document
+        :return: ResponseBody: the serialized body
+        """
+        return cls(simplejson.dumps(doc, ignore_nan=True).encode("utf-8"))
+
+    def get_encoded(self, encoding):
+        """
+        :param encoding: string: a content coding of COMPRESSORS
+        :return: bytes: the body compressed with the content coding
+        """
+        with self._lock:
+            encoded = self._encoded.get(encoding)
+        if encoded is None:
+            encoded = COMPRESSORS[encoding](self.data, int(os.getenv("RESPONSE_COMPRESSION_LEVEL", 6)))
+            with self._lock:
+                self._encoded[encoding] = encoded
+        return encoded
+
+    def send(self, req, resp):
+        """
+        Respond with the body: 304 Not Modified to a GET or HEAD request whose If-None-Match matches its ETag,
+        otherwise the body compressed with the best content coding the client accepts, if it is large enough to be
+        worth compressing. Other methods ignore If-None-Match, as RFC 7232 section 3.2 only allows 304 for GET and
+        HEAD.
+        :param req: falcon.Request: the request
+        :param resp: falcon.Response: the response
+        """
+        resp.content_type = self.content_type
+        resp.set_header("ETag", self.etag)
+        resp.append_header("Vary", "Accept-Encoding")
+
+        if req.method in ("GET", "HEAD") and _matches_etag(req.get_header("If-None-Match"), self.etag):
+            resp.status = falcon.HTTP_304
+            return
+
+        encoding = None
+        if len(self.data) >= int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 1024)):
+            encoding = _get_accepted_encoding(req.get_header("Accept-Encoding"))
+
+        if encoding is None:
+            resp.data = self.data
+        else:
+            resp.set_header("Content-Encoding", encoding)
+            resp.data = self.get_encoded(encoding)
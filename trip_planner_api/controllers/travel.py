@@ -1,46 +1,499 @@
 import json
+import os
+import queue
+import threading
 
 import falcon
 import simplejson
 import structlog
 
+from trip_planner_api.cache import TTLCache
+from trip_planner_api.controllers.responses import ResponseBody
+from trip_planner_api.jobs import JobStoreFullError
+from trip_planner_api.metrics import bind_request_context
+from trip_planner_api.metrics import span
+from trip_planner_api.options_analysis import get_equivalent_travel_cost
+from trip_planner_api.options_analysis import summarize_travel_options_by_date
+from trip_planner_api.plan_trip import TRAVEL_OPTIONS_CACHE
 from trip_planner_api.plan_trip import analyze_travel_option
+from trip_planner_api.plan_trip import analyze_travel_options_batch
+from trip_planner_api.plan_trip import get_travel_options_version
+from trip_planner_api.plan_trip import get_trip_handle
+from trip_planner_api.plan_trip import rank_travel_options
+from trip_planner_api.plan_trip import rerank_travel_options
+from trip_planner_api.plan_trip import rerank_travel_options_for_travelers
 
 structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
+FIXTURE_PATH = "trip_planner_api/fixtures/travel_options.json"
+
+# Serialized responses, kept with the version of the cached travel options they were computed from so that they are
+# only reused while those travel options are
+RESPONSE_BODY_CACHE = TTLCache(
+    name="response_bodies",
+    maxsize=int(os.getenv("TRAVEL_RESPONSE_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("TRAVEL_CACHE_TTL_SECONDS", 300)),
+)
+
+_fixture_bodies = {}
+_fixture_bodies_lock = threading.Lock()
+
+
+def _get_trip_params(req_json):
+    """ Read the parameters relating to the trip itself from the request body """
+    trip_params = dict()
+    trip_params["origin_lat"] = float(req_json["origin_lat"])
+    trip_params["origin_lon"] = float(req_json["origin_lon"])
+    trip_params["destination_lat"] = float(req_json["destination_lat"])
+    trip_params["destination_lon"] = float(req_json["destination_lon"])
+    trip_params["travel_date"] = req_json["travel_date"]
+    if req_json.get("travel_date_to"):
+        trip_params["travel_date_to"] = req_json["travel_date_to"]
+    return trip_params
+
+
+def _get_traveler_params(req_json):
+    """ Read the parameters relating to the traveler's cost and utility functions from the request body """
+    traveler_params = dict()
+    traveler_params["value_one_hour"] = float(req_json["value_one_hour"])
+    traveler_params["value_ten_hours"] = float(req_json["value_ten_hours"])
+    return traveler_params
+
+
+def _get_limit(req_json):
+    """ Read the optional maximum number of travel options to respond with from the request body """
+    if req_json.get("limit") is None:
+        return None
+    return int(req_json["limit"])
+
+
+def _get_fields(req, req_json=None):
+    """
+    Read the optional travel option fields to respond with, from the request body or else the `fields` query parameter,
+    as a list or a comma separated string
+    :return: tuple of strings: the fields, or None to respond with every field
+    """
+    fields = req_json.get("fields") if req_json is not None else None
+    if fields is None:
+        fields = req.get_param("fields")
+    if not fields:
+        return None
+    if not isinstance(fields, list):
+        fields = fields.split(",")
+    return tuple(field.strip() for field in fields if field.strip())
+
+
+def _project_travel_option(travel_option, fields):
+    """ Keep only some fields of a travel option, those missing from it being null """
+    if travel_option is None or fields is None:
+        return travel_option
+    return {field: travel_option.get(field) for field in fields}
+
+
+def _project_result(result, fields):
+    """
+    Keep only some fields of each travel option of a result of `_get_travel_options_result`
+    :param result: list of dicts, or dict with the `options` and their `daily_summary`
+    :param fields: tuple of strings: the fields to keep, or None to keep every field
+    :return: the result with the same structure, holding only the given fields
+    """
+    if result is None or fields is None:
+        return result
+    if not isinstance(result, dict):
+        return [_project_travel_option(travel_option, fields) for travel_option in result]
+    return {
+        "options": _project_result(result["options"], fields),
+        "daily_summary": [
+            dict(summary, cheapest=_project_travel_option(summary["cheapest"], fields),
+                 best=_project_travel_option(summary["best"], fields))
+            for summary in result["daily_summary"]
+        ],
+    }
+
+
+def _get_cached_response_body(key, trip_handle):
+    """
+    Get a response serialized by an earlier request, if the travel options it was computed from are still cached
+    :param key: tuple: the request's key in RESPONSE_BODY_CACHE
+    :param trip_handle: string: handle of the trip's travel options
+    :return: ResponseBody, or None
+    """
+    cached = RESPONSE_BODY_CACHE.get(key)
+    if cached is None:
+        return None
+    version, response_body = cached
+    return response_body if version == get_travel_options_version(trip_handle) else None
+
+
+def _cache_response_body(key, trip_handle, response_body):
+    """ Keep a serialized response for as long as the travel options it was computed from are cached """
+    version = get_travel_options_version(trip_handle)
+    if version is not None:
+        RESPONSE_BODY_CACHE.set(key, (version, response_body))
+
+
+def _get_fixture_body(fields):
+    """
+    Get the serialized travel options of the fixture, which are only read again when the fixture file changes
+    :param fields: tuple of strings: the fields to respond with, or None for every field
+    :return: ResponseBody: the serialized travel options
+    """
+    key = (os.path.getmtime(FIXTURE_PATH), fields)
+    with _fixture_bodies_lock:
+        response_body = _fixture_bodies.get(key)
+    if response_body is None:
+        with open(FIXTURE_PATH, "r") as f:
+            travel_options = json.load(f)
+        response_body = ResponseBody.from_json(_project_result(travel_options, fields))
+        with _fixture_bodies_lock:
+            for stale_key in [k for k in _fixture_bodies if k[0] != key[0]]:
+                del _fixture_bodies[stale_key]
+            _fixture_bodies[key] = response_body
+    return response_body
+
+
+def _get_cached_trip_handle(trip_params):
+    """ Get the handle of a trip's travel options if they are cached and can be reranked, otherwise None """
+    trip_handle = get_trip_handle(trip_params)
+    return trip_handle if trip_handle in TRAVEL_OPTIONS_CACHE else None
+
+
+def _get_analysis_limit(trip_params, limit):
+    """
+    Get the `limit` to analyze a trip's travel options with. The daily summary of a range of travel dates needs the
+    best travel options of every date, so they are neither pruned nor cut down to `limit` before it is made.
+    :param trip_params: dict: parameters relating to the trip itself
+    :param limit: int: maximum number of travel options to respond with, or None
+    :return: int: the limit, or None
+    """
+    return None if trip_params.get("travel_date_to") else limit
+
+
+def _get_travel_options_result(trip_params, ordered_travel_options, limit=None):
+    """
+    Get the travel options to respond with. For a range of travel dates, they come with the cheapest and the best
+    travel option of each departure date, out of all of the travel options.
+    :param trip_params: dict: parameters relating to the trip itself
+    :param ordered_travel_options: list of dicts: the ranked travel options, analyzed with `_get_analysis_limit`
+    :param limit: int: maximum number of travel options to respond with
+    :return: list of dicts, or dict with the `options` and their `daily_summary` for a range of travel dates
+    """
+    options = ordered_travel_options if limit is None else ordered_travel_options[:limit]
+    if not trip_params.get("travel_date_to"):
+        return options
+    return {
+        "options": options,
+        "daily_summary": summarize_travel_options_by_date(ordered_travel_options),
+    }
+
+
+def _stream_travel_options(trip_params, traveler_params, limit=None, fields=None):
+    """
+    Compute the travel options in the background, and yield them as newline delimited JSON events as they are found.
+    Each `option` event holds a travel option scored with the traveler's preferences, and the final `summary` event
+    holds all of the ranked travel options, whether they are incomplete and the handle to rerank them with. For a range
+    of travel dates, the `summary` event also holds the cheapest and the best travel option of each departure date.
+    :param trip_params: dict: parameters relating to the trip itself
+    :param traveler_params: dict: parameters relating to the traveler's cost and utility functions
+    :param limit: int: maximum number of travel options in the summary
+    :param fields: tuple of strings: the travel option fields to respond with, or None for every field
+    :return: generator of bytes: one JSON event per line
+    """
+    # The responder returns before the generator is iterated, and the request context is reset by then, so the
+    # computation is bound to the request and started here rather than in the generator
+    events = queue.Queue()
+
+    def analyze():
+        try:
+            incomplete = []
+            ordered_travel_options = analyze_travel_option(
+                trip_params, traveler_params, on_options=lambda options: events.put(("options", options)),
+                limit=_get_analysis_limit(trip_params, limit), on_incomplete=lambda: incomplete.append(True))
+            events.put(("summary", (ordered_travel_options, bool(incomplete))))
+            events.put(("handle", _get_cached_trip_handle(trip_params)))
+        except Exception as e:
+            logger.error("streaming travel options error", exception=e)
+            events.put(("error", str(e)))
+
+    threading.Thread(target=bind_request_context(analyze), daemon=True).start()
+    return _iterate_events(events, trip_params, traveler_params, limit, fields)
+
+
+def _iterate_events(events, trip_params, traveler_params, limit, fields):
+    """ Yield the events of `_stream_travel_options` as newline delimited JSON, until the final event """
+    while True:
+        event, data = events.get()
+        if event == "options":
+            for option in data:
+                option = dict(option, equivalent_travel_cost=get_equivalent_travel_cost(
+                    total_cost=option["total_cost"],
+                    travel_time_seconds=option["travel_time_seconds"],
+                    value_one_hour=traveler_params["value_one_hour"],
+                    value_ten_hours=traveler_params["value_ten_hours"],
+                ))
+                option = _project_travel_option(option, fields)
+                yield (simplejson.dumps({"event": "option", "data": option}, ignore_nan=True) + "\n").encode("utf-8")
+        elif event == "summary":
+            summary, is_incomplete = data
+        elif event == "handle":
+            result = _project_result(_get_travel_options_result(trip_params, summary, limit), fields)
+            if trip_params.get("travel_date_to"):
+                event = {"event": "summary", "data": result["options"], "is_incomplete": is_incomplete, "handle": data,
+                         "daily_summary": result["daily_summary"]}
+            else:
+                event = {"event": "summary", "data": result, "is_incomplete": is_incomplete, "handle": data}
+            yield (simplejson.dumps(event, ignore_nan=True) + "\n").encode("utf-8")
+            return
+        else:
+            yield (simplejson.dumps({"event": event, "data": data}, ignore_nan=True) + "\n").encode("utf-8")
+            return
+
 
 class TravelOptions(object):
     """ Travel options resource """
+    def __init__(self, job_store):
+        """
+        :param job_store: JobStore: store of the travel options computed in the background
+        """
+        self.job_store = job_store
+
     def on_post(self, req, resp):
         req_body = req.stream.read()
         req_json = json.loads(req_body)
 
         is_debugging = req_json["is_debugging"]
+        fields = _get_fields(req, req_json)
 
         logger.info("requesting TravelOptions API resource", debugging_mode=is_debugging)
 
         if not is_debugging:
-            trip_params = dict()
-            trip_params["origin_lat"] = float(req_json["origin_lat"])
-            trip_params["origin_lon"] = float(req_json["origin_lon"])
-            trip_params["destination_lat"] = float(req_json["destination_lat"])
-            trip_params["destination_lon"] = float(req_json["destination_lon"])
-            trip_params["travel_date"] = req_json["travel_date"]
-
-            traveler_params = dict()
-            traveler_params["value_one_hour"] = float(req_json["value_one_hour"])
-            traveler_params["value_ten_hours"] = float(req_json["value_ten_hours"])
+            trip_params = _get_trip_params(req_json)
+            traveler_params = _get_traveler_params(req_json)
+            limit = _get_limit(req_json)
 
             logger.info("TravelOptions trip parameters", trip_params=trip_params)
             logger.info("TravelOptions traveler parameters", traveler_params=traveler_params)
 
-            ordered_travel_options = analyze_travel_option(trip_params, traveler_params)
-            ordered_travel_options = ordered_travel_options.to_dict(orient="records")
+            if req_json.get("mode") == "job":
+                self._submit_job(resp, trip_params, traveler_params, limit)
+                return
+
+            if req_json.get("mode") == "stream":
+                resp.content_type = "application/x-ndjson"
+                resp.stream = _stream_travel_options(trip_params, traveler_params, limit, fields)
+                return
+
+            # The Pareto frontier of a range of travel dates is taken across the dates, so it has no daily summary
+            frontier_only = req_json.get("mode") == "frontier"
+            trip_handle = get_trip_handle(trip_params)
+            key = ("frontier" if frontier_only else "travel", trip_handle, traveler_params["value_one_hour"],
+                   traveler_params["value_ten_hours"], limit, fields)
+            response_body = _get_cached_response_body(key, trip_handle)
+            incomplete = []
+            if response_body is None:
+                ordered_travel_options = analyze_travel_option(
+                    trip_params, traveler_params, frontier_only=frontier_only,
+                    limit=limit if frontier_only else _get_analysis_limit(trip_params, limit),
+                    on_incomplete=lambda: incomplete.append(True))
+                if not frontier_only:
+                    ordered_travel_options = _get_travel_options_result(trip_params, ordered_travel_options, limit)
+
+                with span("serialization"):
+                    response_body = ResponseBody.from_json(_project_result(ordered_travel_options, fields))
+                if not incomplete:
+                    _cache_response_body(key, trip_handle, response_body)
 
-            resp.content_type = falcon.MEDIA_JSON
-            resp.body = simplejson.dumps(ordered_travel_options, ignore_nan=True)
+            # Incomplete travel options miss the flights of searches that failed or missed the deadline
+            if incomplete:
+                resp.set_header("X-Travel-Options-Incomplete", "true")
+            trip_handle = _get_cached_trip_handle(trip_params)
+            if trip_handle is not None:
+                resp.set_header("X-Trip-Handle", trip_handle)
+
+            response_body.send(req, resp)
+        else:
+            _get_fixture_body(fields).send(req, resp)
+
+    def _submit_job(self, resp, trip_params, traveler_params, limit):
+        """ Start computing the travel options in the background, and respond with the ID of the job """
+        def analyze(job):
+            ordered_travel_options = analyze_travel_option(
+                trip_params, traveler_params, on_options=job.add_partial_results,
+                limit=_get_analysis_limit(trip_params, limit),
+                on_incomplete=lambda: job.set_progress(is_incomplete=True))
+            return _get_travel_options_result(trip_params, ordered_travel_options, limit)
+
+        try:
+            job = self.job_store.submit(
+                analyze, params={"trip_params": trip_params, "traveler_params": traveler_params})
+        except JobStoreFullError:
+            raise falcon.HTTPServiceUnavailable(description="Too many travel option jobs, try again later")
+
+        resp.status = falcon.HTTP_202
+        resp.content_type = falcon.MEDIA_JSON
+        resp.location = "/travel/{}".format(job.job_id)
+        resp.body = json.dumps({"job_id": job.job_id, "status": job.status})
+
+
+class TravelOptionsJob(object):
+    """ Travel options job resource """
+    def __init__(self, job_store):
+        """
+        :param job_store: JobStore: store of the travel options computed in the background
+        """
+        self.job_store = job_store
+
+    def on_get(self, req, resp, job_id):
+        job = self.job_store.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound(description="Travel options job not found or expired")
+
+        trip_handle = None
+        if job.is_finished():
+            results = job.result
+            trip_handle = _get_cached_trip_handle(job.params["trip_params"])
+        else:
+            results = rank_travel_options(job.get_partial_results(), job.params["traveler_params"])
+
+        ResponseBody.from_json({
+            "job_id": job.job_id,
+            "status": job.status,
+            "is_finished": job.is_finished(),
+            "results": _project_result(results, _get_fields(req)),
+            "is_incomplete": job.get_progress().get("is_incomplete", False),
+            "handle": trip_handle,
+            "error": job.error,
+        }).send(req, resp)
+
+
+class TravelOptionsRerank(object):
+    """
+    Resource for reordering the cached travel options of a trip based on new traveler's preferences, or on the
+    preferences of many `travelers` at once
+    """
+    def on_post(self, req, resp):
+        req_body = req.stream.read()
+        req_json = json.loads(req_body)
+
+        is_for_travelers = req_json.get("travelers") is not None
+        if is_for_travelers:
+            traveler_profiles = [_get_traveler_params(traveler_json) for traveler_json in req_json["travelers"]]
         else:
-            with open("trip_planner_api/fixtures/travel_options.json", "r") as f:
-                resp_body = json.load(f)
-            resp.body = json.dumps(resp_body)
+            traveler_profiles = [_get_traveler_params(req_json)]
+        logger.info("requesting TravelOptionsRerank API resource", handle=req_json["handle"],
+                    traveler_params=traveler_profiles)
+
+        trip_handle = req_json["handle"]
+        limit = _get_limit(req_json)
+        fields = _get_fields(req, req_json)
+        key = ("rerank", trip_handle, is_for_travelers,
+               tuple((profile["value_one_hour"], profile["value_ten_hours"]) for profile in traveler_profiles), limit,
+               fields)
+        response_body = _get_cached_response_body(key, trip_handle)
+        if response_body is None:
+            if is_for_travelers:
+                result = rerank_travel_options_for_travelers(trip_handle, traveler_profiles, limit=limit)
+                if result is not None:
+                    result = dict(result, options=_project_result(result["options"], fields))
+            else:
+                result = rerank_travel_options(trip_handle, traveler_profiles[0], limit=limit)
+                result = _project_result(result, fields)
+            if result is None:
+                raise falcon.HTTPNotFound(description="Travel options not found or expired, request /travel again")
+
+            with span("serialization"):
+                response_body = ResponseBody.from_json(result)
+            _cache_response_body(key, trip_handle, response_body)
+
+        resp.set_header("X-Trip-Handle", trip_handle)
+        response_body.send(req, resp)
+
+
+class TravelOptionsBatch(object):
+    """ Resource for computing the travel options of many trips in the background """
+    def __init__(self, job_store):
+        """
+        :param job_store: JobStore: store of the batches computed in the background
+        """
+        self.job_store = job_store
+
+    def on_post(self, req, resp):
+        req_body = req.stream.read()
+        req_json = json.loads(req_body)
+
+        max_trips = int(os.getenv("TRAVEL_BATCH_MAX_TRIPS", 5000))
+        if not req_json.get("trips") or len(req_json["trips"]) > max_trips:
+            raise falcon.HTTPBadRequest(description="A batch must have between 1 and {} trips".format(max_trips))
+
+        trips = []
+        limits = []
+        for trip_json in req_json["trips"]:
+            trip_params = _get_trip_params(trip_json)
+            limits.append(_get_limit(trip_json))
+            trips.append({
+                "trip_params": trip_params,
+                "traveler_params": _get_traveler_params(trip_json),
+                "limit": _get_analysis_limit(trip_params, limits[-1]),
+            })
+        logger.info("requesting TravelOptionsBatch API resource", num_trips=len(trips))
+
+        def analyze(job):
+            def on_progress(phase, trips_completed):
+                job.set_progress(phase=phase, trips_completed=trips_completed)
+
+            def on_result(index, ordered_travel_options, error, is_incomplete):
+                trip_params = trips[index]["trip_params"]
+                job.add_partial_results([{
+                    "index": index,
+                    "results": None if error else _get_travel_options_result(
+                        trip_params, ordered_travel_options, limits[index]),
+                    "is_incomplete": is_incomplete,
+                    "handle": None if error else _get_cached_trip_handle(trip_params),
+                    "error": error,
+                }])
+
+            job.set_progress(phase="pending", trips_completed=0, trips_total=len(trips))
+            analyze_travel_options_batch(trips, on_progress=on_progress, on_result=on_result)
+            return job.get_partial_results()
+
+        try:
+            job = self.job_store.submit(analyze, params={"num_trips": len(trips)})
+        except JobStoreFullError:
+            raise falcon.HTTPServiceUnavailable(description="Too many travel option batches, try again later")
+
+        resp.status = falcon.HTTP_202
+        resp.content_type = falcon.MEDIA_JSON
+        resp.location = "/travel/batch/{}".format(job.job_id)
+        resp.body = json.dumps({"job_id": job.job_id, "status": job.status})
+
+
+class TravelOptionsBatchJob(object):
+    """ Travel options batch job resource """
+    def __init__(self, job_store):
+        """
+        :param job_store: JobStore: store of the batches computed in the background
+        """
+        self.job_store = job_store
+
+    def on_get(self, req, resp, job_id):
+        job = self.job_store.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound(description="Travel options batch not found or expired")
+
+        progress = job.get_progress()
+        progress.setdefault("trips_total", job.params["num_trips"])
+
+        fields = _get_fields(req)
+        results = job.result if job.is_finished() else job.get_partial_results()
+        if results is not None and fields is not None:
+            results = [dict(result, results=_project_result(result["results"], fields)) for result in results]
+
+        ResponseBody.from_json({
+            "job_id": job.job_id,
+            "status": job.status,
+            "is_finished": job.is_finished(),
+            "progress": progress,
+            "results": results,
+            "error": job.error,
+        }).send(req, resp)
@@ -1,7 +1,5 @@
 import structlog
 
-import pandas as pd
-
 from trip_planner_api.util import get_duration_string_from_seconds
 from trip_planner_api.util import get_gas_cost
 from trip_planner_api.util import make_distance_matrix_request
@@ -10,28 +8,33 @@ structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
 
-def _get_driving_option(origin_lat, origin_lon, destination_lat, destination_lon):
+def _get_driving_option(origin_lat, origin_lon, destination_lat, destination_lon, driving_info=None,
+                        gas_cost_per_liter=None):
     """
     Get the travel information for the driving option
     :param origin_lat: float: latitude of the origin
     :param origin_lon: float: longitude of the origin
     :param destination_lat: float: latitude of the destination
     :param destination_lon: float: longitude of the destination
-    :return: pandas.DataFrame: one row containing the travel option of driving
+    :param driving_info: dict: distance and duration from the origin to the destination, requested here if not given
+    :param gas_cost_per_liter: float: gas cost per liter near the origin, looked up if not given
+    :return: list of dicts: one dict containing the travel option of driving
     """
-    driving_info = make_distance_matrix_request(
-        origins="{},{}".format(origin_lat, origin_lon),
-        destinations="{},{}".format(destination_lat, destination_lon),
-        origin_labels=["origin"],
-        destination_labels=["destination"],
-        group_by_origins=True,
-    )
-    driving_info = driving_info["origin"]["destination"]
+    if driving_info is None:
+        driving_info = make_distance_matrix_request(
+            origins="{},{}".format(origin_lat, origin_lon),
+            destinations="{},{}".format(destination_lat, destination_lon),
+            origin_labels=["origin"],
+            destination_labels=["destination"],
+            group_by_origins=True,
+        )
+        driving_info = driving_info["origin"]["destination"]
     duration = driving_info["duration"]["value"]
     gas_cost = get_gas_cost(
         distance_meters=driving_info["distance"]["value"],
         latitude=origin_lat,
         longitude=origin_lon,
+        cost_per_liter=gas_cost_per_liter,
     )
 
     driving_option = [{
@@ -44,10 +47,11 @@ def _get_driving_option(origin_lat, origin_lon, destination_lat, destination_lon
         "travel_method": "driving",
     }]
 
-    return pd.DataFrame(driving_option)
+    return driving_option
 
 
-def get_all_ground_travel_options(origin_lat, origin_lon, destination_lat, destination_lon, travel_date):
+def get_all_ground_travel_options(origin_lat, origin_lon, destination_lat, destination_lon, travel_date,
+                                  driving_legs=None, gas_cost_per_liter=None):
     """
     Get all of the ground travel options and the detailed information about the options
     :param origin_lat: float: latitude of the origin
@@ -55,10 +59,16 @@ def get_all_ground_travel_options(origin_lat, origin_lon, destination_lat, desti
     :param destination_lat: float: latitude of the destination
     :param destination_lon: float: longitude of the destination
     :param travel_date: string ("dd/mm/yyyy"): departure date
-    :return: pandas.DataFrame: each row is a travel option, and each column is some information about the travel option
+    :param driving_legs: dict: driving legs of the trip from `get_trip_driving_legs`, if already resolved
+    :param gas_cost_per_liter: float: gas cost per liter near the origin, if already looked up
+    :return: list of dicts: each dict is a travel option, and each key is some information about the travel option
     """
     logger.info("getting all ground travel options")
 
-    driving_option = _get_driving_option(origin_lat, origin_lon, destination_lat, destination_lon)
+    driving_option = _get_driving_option(
+        origin_lat, origin_lon, destination_lat, destination_lon,
+        driving_info=driving_legs["driving"] if driving_legs is not None else None,
+        gas_cost_per_liter=gas_cost_per_liter,
+    )
 
     return driving_option
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import structlog
+
+from trip_planner_api.cache import make_cache
+from trip_planner_api.metrics import RequestContextExecutor
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class JobStoreFullError(Exception):
+    """ Raised when a job is submitted while the job store is full of unexpired jobs """
+
+
+class Job(object):
+    """ A computation running in the background, and the results it has produced so far """
+    def __init__(self, job_id, params=None):
+        """
+        :param job_id: string: unique ID of the job
+        :param params: dict: parameters the job was submitted with, kept for reading its results
+        """
+        self.job_id = job_id
+        self.params = params or {}
+        self.status = JOB_PENDING
+        self.created_at = time.time()
+        self.finished_at = None
+        self.partial_results = []
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.on_change = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_snapshot(cls, snapshot, partial_results):
+        """
+        Rebuild a job from its snapshot, e.g. one published by another worker process
+        :param snapshot: dict: the snapshot, from `to_snapshot`
+        :param partial_results: list: all of the results the job had found when the snapshot was taken
+        :return: Job: the job, which is not running in this process
+        """
+        job = cls(job_id=snapshot["job_id"], params=snapshot["params"])
+        for key in ("status", "created_at", "finished_at", "progress", "result", "error"):
+            setattr(job, key, snapshot[key])
+        job.partial_results = partial_results
+        return job
+
+    def to_snapshot(self, results_offset=0):
+        """
+        :param results_offset: int: number of partial results that were already stored, which are left out
+        :return: dict: the state of the job, which can be stored in a shared cache, with the partial results from
+            `results_offset` on as `new_partial_results`, and the number of partial results as `num_partial_results`
+        """
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "params": self.params,
+                "status": self.status,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "new_partial_results": self.partial_results[results_offset:],
+                "num_partial_results": len(self.partial_results),
+                "progress": dict(self.progress),
+                "result": self.result,
+                "error": self.error,
+            }
+
+    def _changed(self):
+        """ Notify the job store that the job's results or progress changed """
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def add_partial_results(self, results):
+        """
+        Record results found before the job is finished. Safe to call from several threads at once.
+        :param results: list: results to add
+        """
+        with self._lock:
+            self.partial_results.extend(results)
+        self._changed()
+
+    def get_partial_results(self):
+        """
+        :return: list: copy of the results found so far
+        """
+        with self._lock:
+            return list(self.partial_results)
+
+    def set_progress(self, **progress):
+        """
+        Record how far the job has gotten. Safe to call from several threads at once.
+        :param progress: values describing the progress of the job, which replace the previous ones
+        """
+        with self._lock:
+            self.progress.update(progress)
+        self._changed()
+
+    def get_progress(self):
+        """
+        :return: dict: copy of the progress of the job
+        """
+        with self._lock:
+            return dict(self.progress)
+
+    def is_finished(self):
+        """
+        :return: boolean: True if the job has succeeded or failed
+        """
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class JobStore(object):
+    """
+    Bounded store of background jobs, which expire some time after they finish. Jobs run in the worker process they
+    are submitted to. With CACHE_BACKEND=sqlite, each job's state is also published to a shared cache as it changes,
+    so that any worker process can respond with it. Partial results are appended to the shared cache in chunks, each
+    holding the results found since the previous publish, so that a publish only writes what is new.
+    """
+    # Unfinished jobs are kept long enough for any job to finish. A job whose worker process stops is reported as
+    # unfinished until then.
+    UNFINISHED_JOB_TTL_SECONDS = 86400
+    # An hour of publishes at the default interval
+    RESULT_CHUNKS_PER_JOB = 7200
+
+    def __init__(self, max_jobs, ttl, max_workers, name="jobs"):
+        """
+        :param max_jobs: int: maximum number of jobs to keep in this process
+        :param ttl: float: number of seconds a finished job is kept
+        :param max_workers: int: maximum number of jobs running at the same time
+        :param name: string: name of the shared cache of the jobs
+        """
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = RequestContextExecutor(max_workers=max_workers)
+        self._shared_jobs = None
+        self._shared_job_results = None
+        if os.getenv("CACHE_BACKEND", "memory") != "memory":
+            self._shared_jobs = make_cache(name=name, maxsize=max_jobs * 10, ttl=ttl)
+            self._shared_job_results = make_cache(
+                name="{}_results".format(name), maxsize=max_jobs * self.RESULT_CHUNKS_PER_JOB,
+                ttl=self.UNFINISHED_JOB_TTL_SECONDS)
+        # Time of the last publish of each job, and the numbers of partial results and chunks it had published
+        self._published = {}
+        self._publish_lock = threading.Lock()
+
+    def _publish(self, job, is_forced=False):
+        """
+        Store the state of a job in the shared cache, at most every JOB_PUBLISH_INTERVAL_SECONDS unless forced. The
+        partial results found since the last publish are appended as a new chunk, and the job's snapshot only records
+        how many chunks there are.
+        :param job: Job: the job
+        :param is_forced: boolean: True to publish right away, e.g. when the job's status changes
+        """
+        if self._shared_jobs is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            published = self._published.get(job.job_id, (0, 0, 0))
+            if not is_forced and now - published[0] < float(os.getenv("JOB_PUBLISH_INTERVAL_SECONDS", 0.5)):
+                return
+            self._published[job.job_id] = (now,) + published[1:]
+
+        # Publishes of a job are serialized, so that each chunk of partial results is appended once and in order
+        with self._publish_lock:
+            _, num_results, num_chunks = self._published.get(job.job_id, (0, 0, 0))
+            snapshot = job.to_snapshot(results_offset=num_results)
+            new_partial_results = snapshot.pop("new_partial_results")
+            if new_partial_results:
+                self._shared_job_results.set((job.job_id, num_chunks), new_partial_results)
+                num_chunks += 1
+            snapshot["num_result_chunks"] = num_chunks
+
+            ttl = self.ttl if job.is_finished() else self.UNFINISHED_JOB_TTL_SECONDS
+            self._shared_jobs.set(job.job_id, snapshot, ttl=ttl)
+            with self._lock:
+                self._published[job.job_id] = (now, snapshot["num_partial_results"], num_chunks)
+
+    def _get_shared_partial_results(self, job_id, num_chunks):
+        """
+        Read the partial results a job published to the shared cache
+        :param job_id: string: ID of the job
+        :param num_chunks: int: number of chunks of partial results the job published
+        :return: list: the partial results, in the order they were found
+        """
+        partial_results = []
+        for chunk in range(num_chunks):
+            chunk_results = self._shared_job_results.get((job_id, chunk))
+            if chunk_results is None:
+                logger.warning("job partial results missing", job_id=job_id, chunk=chunk)
+                continue
+            partial_results.extend(chunk_results)
+        return partial_results
+
+    def _remove_expired_jobs(self):
+        """ Remove the finished jobs that have expired. Must be called with the lock held. """
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items() if job.is_finished() and job.finished_at + self.ttl < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._published.pop(job_id, None)
+
+    def submit(self, target, params=None):
+        """
+        Run a function in the background as a new job
+        :param target: function: called with the Job, and returns the final result of the job
+        :param params: dict: parameters of the job, kept on the Job
+        :return: Job: the submitted job
+        """
+        job = Job(job_id=uuid.uuid4().hex, params=params)
+        with self._lock:
+            self._remove_expired_jobs()
+            if len(self._jobs) >= self.max_jobs:
+                raise JobStoreFullError("too many jobs")
+            self._jobs[job.job_id] = job
+
+        job.on_change = self._publish
+        self._publish(job, is_forced=True)
+        self._executor.submit(self._run, job, target)
+        logger.info("job submitted", job_id=job.job_id)
+
+        return job
+
+    def _run(self, job, target):
+        """ Run a job, and record its result or error """
+        job.status = JOB_RUNNING
+        self._publish(job, is_forced=True)
+        try:
+            job.result = target(job)
+            job.finished_at = time.time()
+            job.status = JOB_SUCCEEDED
+        except Exception as e:
+            logger.error("job failed", job_id=job.job_id, exception=e)
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = JOB_FAILED
+        self._publish(job, is_forced=True)
+        logger.info("job finished", job_id=job.job_id, status=job.status, seconds=job.finished_at - job.created_at)
+
+    def get(self, job_id):
+        """
+        Look up a job, in this process or else in the shared cache
+        :param job_id: string: ID of the job
+        :return: Job: the job, or None if it does not exist or has expired
+        """
+        with self._lock:
+            self._remove_expired_jobs()
+            job = self._jobs.get(job_id)
+        if job is None and self._shared_jobs is not None:
+            snapshot = self._shared_jobs.get(job_id)
+            if snapshot is not None:
+                partial_results = self._get_shared_partial_results(job_id, snapshot["num_result_chunks"])
+                job = Job.from_snapshot(snapshot, partial_results)
+        return job
@@ -0,0 +1,171 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import structlog
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 150.0)
+
+# Priority classes of the upstream calls made for a request, see trip_planner_api.rate_limit
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+_request_context = threading.local()
+
+
+def get_request_id():
+    """
+    :return: string: ID of the request handled by the current thread, or None
+    """
+    return getattr(_request_context, "request_id", None)
+
+
+def set_request_id(request_id):
+    """
+    Set the ID of the request handled by the current thread
+    :param request_id: string: ID of the request, or None once the request is handled
+    """
+    _request_context.request_id = request_id
+
+
+def get_request_priority():
+    """
+    :return: string: priority class of the work done by the current thread, PRIORITY_INTERACTIVE unless set
+    """
+    return getattr(_request_context, "priority", None) or PRIORITY_INTERACTIVE
+
+
+def set_request_priority(priority):
+    """
+    Set the priority class of the work done by the current thread
+    :param priority: string: PRIORITY_INTERACTIVE or PRIORITY_BATCH, or None once the request is handled
+    """
+    _request_context.priority = priority
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Do the work within the block, and in the threads it binds with `bind_request_context`, with a priority class
+    :param priority: string: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+    """
+    previous_priority = getattr(_request_context, "priority", None)
+    set_request_priority(priority)
+    try:
+        yield
+    finally:
+        set_request_priority(previous_priority)
+
+
+def bind_request_context(fn):
+    """
+    Bind a function to the current thread's request, so that the request ID and priority class are kept when it runs
+    in another thread
+    :param fn: function: function to bind
+    :return: function: the bound function
+    """
+    request_id = get_request_id()
+    priority = getattr(_request_context, "priority", None)
+
+    def run(*args, **kwargs):
+        previous_request_id = get_request_id()
+        previous_priority = getattr(_request_context, "priority", None)
+        set_request_id(request_id)
+        set_request_priority(priority)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            set_request_id(previous_request_id)
+            set_request_priority(previous_priority)
+
+    return run
+
+
+class RequestContextExecutor(ThreadPoolExecutor):
+    """ Thread pool executor that runs each submitted function with the request ID of the thread that submitted it """
+    def submit(self, fn, *args, **kwargs):
+        return super(RequestContextExecutor, self).submit(bind_request_context(fn), *args, **kwargs)
+
+
+class Histogram(object):
+    """ Thread-safe histogram of observed values, with one series per label value, in the Prometheus format """
+    def __init__(self, name, description, label_name, buckets=DEFAULT_BUCKETS):
+        """
+        :param name: string: name of the metric
+        :param description: string: help text of the metric
+        :param label_name: string: name of the label distinguishing the series
+        :param buckets: tuple of floats: upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """
+        Record an observed value
+        :param label_value: string: value of the label of the series
+        :param value: float: observed value
+        """
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self._series[label_value] = series
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series["buckets"][i] += 1
+            series["count"] += 1
+            series["sum"] += value
+
+    def render(self):
+        """
+        :return: list of strings: lines of the histogram in the Prometheus text format
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = '{}="{}"'.format(self.label_name, label_value)
+                for upper_bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, upper_bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, series["count"]))
+                lines.append("{}_sum{{{}}} {}".format(self.name, label, series["sum"]))
+                lines.append("{}_count{{{}}} {}".format(self.name, label, series["count"]))
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "trip_planner_stage_seconds", "Duration of each stage of finding and ranking travel options", "stage")
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "trip_planner_upstream_request_seconds", "Duration of each request to an upstream API", "upstream")
+UPSTREAM_QUEUE_SECONDS = Histogram(
+    "trip_planner_upstream_queue_seconds", "Time each request to an upstream API waited for its rate limit", "upstream")
+HTTP_REQUEST_SECONDS = Histogram(
+    "trip_planner_http_request_seconds", "Duration of handling each API request", "route")
+
+HISTOGRAMS = [STAGE_SECONDS, UPSTREAM_REQUEST_SECONDS, UPSTREAM_QUEUE_SECONDS, HTTP_REQUEST_SECONDS]
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Time a stage of the current request, log its duration with the request ID, and record it in STAGE_SECONDS
+    :param stage: string: name of the stage
+    :param fields: extra information logged with the duration
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        STAGE_SECONDS.observe(stage, seconds)
+        logger.info("stage timing", request_id=get_request_id(), stage=stage, seconds=seconds, **fields)
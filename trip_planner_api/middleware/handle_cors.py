@@ -14,6 +14,8 @@ class HandleCORS(object):
 
         resp.set_header("Access-Control-Allow-Methods", "*")
         resp.set_header("Access-Control-Allow-Headers", "*")
+        resp.set_header(
+            "Access-Control-Expose-Headers", "X-Trip-Handle, X-Request-ID, ETag, X-Travel-Options-Incomplete")
 
         if req.method == "OPTIONS":
             raise HTTPStatus(falcon.HTTP_200, body="\n")
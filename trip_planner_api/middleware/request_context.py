@@ -0,0 +1,21 @@
+import time
+import uuid
+
+from trip_planner_api.metrics import HTTP_REQUEST_SECONDS
+from trip_planner_api.metrics import set_request_id
+from trip_planner_api.metrics import set_request_priority
+
+
+class RequestContext(object):
+    """ Gives each request an ID for its logs and timing spans, and records how long each route takes """
+    def process_request(self, req, resp):
+        request_id = req.get_header("X-Request-ID") or uuid.uuid4().hex
+        req.context["request_id"] = request_id
+        req.context["start_time"] = time.time()
+        set_request_id(request_id)
+        resp.set_header("X-Request-ID", request_id)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        HTTP_REQUEST_SECONDS.observe(req.uri_template or "unrouted", time.time() - req.context["start_time"])
+        set_request_id(None)
+        set_request_priority(None)
@@ -1,31 +1,148 @@
 import math
+from datetime import datetime
 
+import numpy
 import structlog
 
 structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
 
-def add_equivalent_travel_cost(travel_options, value_one_hour, value_ten_hours):
+def _get_time_value_parameters(value_one_hour, value_ten_hours):
     """
-    Calculate the dollar equivalent of the travel time, add that to the monetary travel cost, and store the results
-    in a new column called `equivalent_travel_cost`
-    :param travel_options: pandas.DataFrame: each row is a travel option
-    :param value_one_hour:int: value in dollars of 1 hour of time
+    Fit the parameters of the formula Y = a(X^b), where X is the travel time in hours, and Y is the dollar equivalent
+    value, to the traveler's values of time
+    :param value_one_hour: int: value in dollars of 1 hour of time
     :param value_ten_hours: int: value in dollars of 10 hours of time
-    :return: pandas.DataFrame: travel_options with the new column `equivalent_travel_cost`
+    :return: tuple of floats: a and b
     """
-    # Formula used:  Y = a(X^b), where X is the travel time in hours, and Y is the dollar equivalent value
     a = value_one_hour
     b = math.log(value_ten_hours / value_one_hour) / math.log(10)
-    logger.info("Calculating dollar equivalent of travel time", formula="Y = a(X^b)", a=a, b=b)
+    return a, b
 
-    def calculate_equivalent_travel_cost(row):
-        """ Calculate the equivalent travel cost for a single travel option """
-        travel_time_hours = row.travel_time_seconds / 3600
-        time_value = a * (travel_time_hours ** b)
-        return row.total_cost + time_value
 
-    travel_options["equivalent_travel_cost"] = travel_options.apply(calculate_equivalent_travel_cost, axis=1)
+def get_equivalent_travel_cost(total_cost, travel_time_seconds, value_one_hour, value_ten_hours):
+    """
+    Calculate the equivalent travel cost of a single travel option
+    :param total_cost: float: monetary cost of the travel option in dollars
+    :param travel_time_seconds: int: travel time of the travel option in seconds
+    :param value_one_hour: int: value in dollars of 1 hour of time
+    :param value_ten_hours: int: value in dollars of 10 hours of time
+    :return: float: monetary cost plus the dollar equivalent of the travel time
+    """
+    a, b = _get_time_value_parameters(value_one_hour, value_ten_hours)
+    return total_cost + a * ((travel_time_seconds / 3600) ** b)
+
+
+def get_ranking_columns(travel_options):
+    """
+    Get the inputs of the equivalent travel cost of travel options as columns, so that they are kept once with the
+    travel options and scored all at once
+    :param travel_options: list of dicts: each dict is a travel option
+    :return: dict: `total_cost` and `travel_time_seconds` lists of floats, in the same order as the travel options
+    """
+    return {
+        "total_cost": [float(option["total_cost"]) for option in travel_options],
+        "travel_time_seconds": [float(option["travel_time_seconds"]) for option in travel_options],
+    }
+
+
+def get_equivalent_travel_costs(columns, traveler_profiles):
+    """
+    Calculate the equivalent travel cost of every travel option for many travelers at once, as a single vectorized
+    computation of the formula Y = a(X^b) over the columns of the travel options and the parameters of the travelers
+    :param columns: dict: `total_cost` and `travel_time_seconds` columns of the travel options, from
+        `get_ranking_columns`
+    :param traveler_profiles: list of dicts: each dict holds a traveler's `value_one_hour` and `value_ten_hours`
+    :return: numpy.ndarray: equivalent travel costs, with one row per traveler profile (in the same order as
+        `traveler_profiles`) and one column per travel option
+    """
+    parameters = numpy.array(
+        [_get_time_value_parameters(p["value_one_hour"], p["value_ten_hours"]) for p in traveler_profiles],
+        dtype=float).reshape(-1, 2)
+    logger.info("Calculating dollar equivalent of travel time", formula="Y = a(X^b)",
+                num_options=len(columns["total_cost"]), num_profiles=len(traveler_profiles))
+
+    total_cost = numpy.asarray(columns["total_cost"], dtype=float)
+    travel_time_hours = numpy.asarray(columns["travel_time_seconds"], dtype=float) / 3600
+    a = parameters[:, 0:1]
+    b = parameters[:, 1:2]
+    with numpy.errstate(divide="ignore"):
+        return total_cost + a * (travel_time_hours ** b)
+
+
+def get_ranked_indices(equivalent_travel_costs, limit=None):
+    """
+    Order travel options by their equivalent travel costs, for each traveler
+    :param equivalent_travel_costs: numpy.ndarray: from `get_equivalent_travel_costs`
+    :param limit: int: if given, only the indices of the `limit` best travel options are kept
+    :return: numpy.ndarray: for each traveler profile, the indices of the travel options from best to worst. Travel
+        options with the same cost keep their order.
+    """
+    ranked_indices = numpy.argsort(equivalent_travel_costs, axis=1, kind="stable")
+    return ranked_indices if limit is None else ranked_indices[:, :limit]
+
+
+def get_pareto_frontier(items, key=None):
+    """
+    Find the items that no other item beats on both cost and time, in O(n log n): once sorted by cost and then by time,
+    an item is on the frontier exactly when it is faster than every item before it
+    :param items: list: travel options, or any items that `key` applies to
+    :param key: function: returns the cost and the time of an item, as a tuple (defaults to the `total_cost` and
+        `travel_time_seconds` of a travel option)
+    :return: list: the items on the frontier, by increasing cost and decreasing time. Of several items with the same
+        cost and time, only one is kept.
+    """
+    if key is None:
+        def key(option):
+            return option["total_cost"], option["travel_time_seconds"]
+
+    frontier = []
+    fastest_time = None
+    for (_, travel_time), _, item in sorted((key(item), i, item) for i, item in enumerate(items)):
+        if fastest_time is None or travel_time < fastest_time:
+            frontier.append(item)
+            fastest_time = travel_time
+
+    return frontier
+
+
+def summarize_travel_options_by_date(ordered_travel_options):
+    """
+    Find the cheapest and the best travel option of each departure date. Travel options without a departure date (e.g.
+    driving) can be taken on any date, so they are candidates on every date.
+    :param ordered_travel_options: list of dicts: travel options with their `equivalent_travel_cost`, where flight
+        options have a `departure_date` ("dd/mm/yyyy")
+    :return: list of dicts: for each departure date in chronological order, the `departure_date`, the `cheapest`
+        travel option, and the `best` travel option by equivalent travel cost
+    """
+    any_date_options = []
+    options_by_date = {}
+    for option in ordered_travel_options:
+        if option.get("departure_date"):
+            options_by_date.setdefault(option["departure_date"], []).append(option)
+        else:
+            any_date_options.append(option)
+
+    summary = []
+    for departure_date in sorted(options_by_date, key=lambda date: datetime.strptime(date, "%d/%m/%Y")):
+        options = options_by_date[departure_date] + any_date_options
+        summary.append({
+            "departure_date": departure_date,
+            "cheapest": min(options, key=lambda option: option["total_cost"]),
+            "best": min(options, key=lambda option: option["equivalent_travel_cost"]),
+        })
+
+    return summary
+
+
+def to_dataframe(travel_options):
+    """
+    Export travel options to a pandas DataFrame for analysis. pandas is only imported here, and is not needed to find
+    or rank travel options.
+    :param travel_options: list of dicts: each dict is a travel option
+    :return: pandas.DataFrame: each row is a travel option, and each column is some information about the travel option
+    """
+    import pandas as pd
 
-    return travel_options
+    return pd.DataFrame(travel_options)
@@ -1,14 +1,356 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError
+
+import numpy
 import structlog
 
+from trip_planner_api.air_travel import AIRPORT_CACHE
+from trip_planner_api.air_travel import FLIGHT_CACHE
+from trip_planner_api.air_travel import find_candidate_airports
 from trip_planner_api.air_travel import get_all_air_travel_options
+from trip_planner_api.air_travel import prefetch_flights
+from trip_planner_api.air_travel import prefetch_nearby_airports
+from trip_planner_api.cache import SingleFlight
+from trip_planner_api.cache import make_cache
 from trip_planner_api.ground_travel import get_all_ground_travel_options
-from trip_planner_api.options_analysis import add_equivalent_travel_cost
+from trip_planner_api.metrics import PRIORITY_BATCH
+from trip_planner_api.metrics import RequestContextExecutor
+from trip_planner_api.metrics import request_priority
+from trip_planner_api.metrics import span
+from trip_planner_api.options_analysis import get_equivalent_travel_cost
+from trip_planner_api.options_analysis import get_equivalent_travel_costs
+from trip_planner_api.options_analysis import get_pareto_frontier
+from trip_planner_api.options_analysis import get_ranked_indices
+from trip_planner_api.options_analysis import get_ranking_columns
+from trip_planner_api.options_analysis import to_dataframe
+from trip_planner_api.util import DISTANCE_MATRIX_CACHE
+from trip_planner_api.util import GAS_PRICE_CACHE
+from trip_planner_api.util import get_gas_cost_per_liter
+from trip_planner_api.util import get_trip_driving_leg_locations
+from trip_planner_api.util import get_trip_driving_legs
+from trip_planner_api.util import prefetch_driving_legs
+from trip_planner_api.util import prefetch_gas_prices
 
 structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
+AIR_TRAVEL_EXECUTOR = RequestContextExecutor(max_workers=int(os.getenv("AIR_TRAVEL_WORKERS", 16)))
+
+# Shared by every worker process with CACHE_BACKEND=sqlite, so that a trip handle can be reranked by any of them
+TRAVEL_OPTIONS_CACHE = make_cache(
+    name="travel_options",
+    maxsize=int(os.getenv("TRAVEL_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("TRAVEL_CACHE_TTL_SECONDS", 300)),
+)
+# A new version is set each time a trip's travel options are cached, to tell results computed from them apart
+TRAVEL_OPTIONS_VERSIONS = make_cache(
+    name="travel_options_versions",
+    maxsize=int(os.getenv("TRAVEL_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("TRAVEL_CACHE_TTL_SECONDS", 300)),
+)
+TRAVEL_OPTIONS_REQUESTS = SingleFlight()
+
+
+def _get_travel_option_fields(travel_options):
+    """ Get every field of some travel options, in the order they first appear """
+    fields = OrderedDict()
+    for option in travel_options:
+        fields.update(dict.fromkeys(option))
+    return list(fields)
+
+
+def _fill_travel_option(travel_option, fields, equivalent_travel_cost=None, rank=None):
+    """
+    Copy a travel option with the given fields that it does not have set to None, and with its equivalent travel cost
+    and rank for a traveler if they are given
+    """
+    option = dict(travel_option)
+    if equivalent_travel_cost is not None:
+        option["equivalent_travel_cost"] = equivalent_travel_cost
+    for field in fields:
+        option.setdefault(field, None)
+    if rank is not None:
+        option["rank"] = rank
+    return option
+
+
+def rank_travel_options(travel_options, traveler_params, limit=None, columns=None):
+    """
+    Order the travel options based on the traveler's preferences. Every ordered travel option has the same fields,
+    which are None where they do not apply (e.g. the airports of driving).
+    :param travel_options: list of dicts: each dict is a travel option, which is not modified
+    :param traveler_params: dict: parameters relating to the traveler's cost and utility functions
+        value_one_hour: int: value in dollars of 1 hour of time
+        value_ten_hours: int: value in dollars of 10 hours of time
+    :param limit: int: if given, only the `limit` best travel options are returned
+    :param columns: dict: columns of the travel options, from `get_ranking_columns`, if they are already known
+    :return: list of dicts: copies of the travel options with their `equivalent_travel_cost` and `rank`, ordered by
+        rank
+    """
+    logger.info("analyze the travel options and ordering by preference")
+    with span("scoring", num_options=len(travel_options)):
+        if columns is None:
+            columns = get_ranking_columns(travel_options)
+        equivalent_travel_costs = get_equivalent_travel_costs(columns, [traveler_params])
+    with span("sort", num_options=len(travel_options)):
+        ranked_indices = get_ranked_indices(equivalent_travel_costs, limit=limit)[0]
+        ranked_costs = equivalent_travel_costs[0][ranked_indices].tolist()
+        fields = _get_travel_option_fields(travel_options)
+        return [
+            _fill_travel_option(travel_options[i], fields, equivalent_travel_cost=cost, rank=rank)
+            for rank, (i, cost) in enumerate(zip(ranked_indices.tolist(), ranked_costs))
+        ]
+
+
+def rank_travel_options_for_travelers(travel_options, traveler_profiles, limit=None, columns=None):
+    """
+    Order the same travel options for many travelers at once, scoring every travel option for all of them in one pass.
+    Each travel option is returned once, and each traveler's ranking refers to them by index.
+    :param travel_options: list of dicts: each dict is a travel option, which is not modified
+    :param traveler_profiles: list of dicts: parameters relating to each traveler's cost and utility functions, as
+        taken by `rank_travel_options`
+    :param limit: int: if given, only the `limit` best travel options of each traveler are ranked
+    :param columns: dict: columns of the travel options, from `get_ranking_columns`, if they are already known
+    :return: dict:
+        options: list of dicts: copies of the ranked travel options, with the same fields
+        rankings: list of dicts: for each traveler profile, in the same order, the `order` of the travel options from
+            best to worst (as indices of `options`) and their `equivalent_travel_costs`
+    """
+    logger.info("analyze the travel options and ordering by preference for many travelers",
+                num_travelers=len(traveler_profiles))
+    with span("scoring", num_options=len(travel_options), num_travelers=len(traveler_profiles)):
+        if columns is None:
+            columns = get_ranking_columns(travel_options)
+        equivalent_travel_costs = get_equivalent_travel_costs(columns, traveler_profiles)
+    with span("sort", num_options=len(travel_options), num_travelers=len(traveler_profiles)):
+        ranked_indices = get_ranked_indices(equivalent_travel_costs, limit=limit)
+        ranked_costs = numpy.take_along_axis(equivalent_travel_costs, ranked_indices, axis=1)
+        option_indices = numpy.unique(ranked_indices)
+        orders = numpy.searchsorted(option_indices, ranked_indices)
 
-def analyze_travel_option(trip_params, traveler_params):
+        fields = _get_travel_option_fields(travel_options)
+        return {
+            "options": [_fill_travel_option(travel_options[i], fields) for i in option_indices.tolist()],
+            "rankings": [
+                {"order": order, "equivalent_travel_costs": costs}
+                for order, costs in zip(orders.tolist(), ranked_costs.tolist())
+            ],
+        }
+
+
+def get_trip_handle(trip_params):
+    """
+    Get the handle of a trip's travel options. Nearby trips on the same date share their travel options, so the
+    handle is derived from the rounded coordinates of the origin and the destination, and the travel dates.
+    :param trip_params: dict: parameters relating to the trip itself
+    :return: string: handle of the trip's travel options
+    """
+    precision = int(os.getenv("TRAVEL_CACHE_PRECISION", 3))
+    trip_key = "{:.{p}f},{:.{p}f},{:.{p}f},{:.{p}f},{},{}".format(
+        trip_params["origin_lat"],
+        trip_params["origin_lon"],
+        trip_params["destination_lat"],
+        trip_params["destination_lon"],
+        trip_params["travel_date"],
+        trip_params.get("travel_date_to") or "",
+        p=precision,
+    )
+    return hashlib.sha1(trip_key.encode("utf-8")).hexdigest()
+
+
+def get_travel_options_version(trip_handle):
+    """
+    Get the version of a trip's cached travel options, which changes whenever they are found again
+    :param trip_handle: string: handle of the trip's travel options, from `get_trip_handle`
+    :return: string: the version, or None if the trip's travel options are not cached
+    """
+    if trip_handle is None or trip_handle not in TRAVEL_OPTIONS_CACHE:
+        return None
+    return TRAVEL_OPTIONS_VERSIONS.get(trip_handle)
+
+
+def _find_travel_options(trip_params, deadline, on_options=None, traveler_params=None, limit=None,
+                         frontier_only=False):
+    """
+    Find the air and ground travel options of a trip, without ordering them
+    :param trip_params: dict: parameters relating to the trip itself
+    :param deadline: float: time (as given by time.time()) after which the air travel options, including their airport
+        lookup, are abandoned
+    :param on_options: function: called with lists of travel options (as dicts) as soon as they are found
+    :param traveler_params: dict: parameters relating to the traveler's cost and utility functions, needed with `limit`
+    :param limit: int: if given, airport pairs that cannot contain any of the `limit` best travel options are skipped
+    :param frontier_only: boolean: if True, the flights of each airport pair that cannot be on the Pareto frontier are
+        discarded as they are found
+    :return: tuple: list of dicts, each dict being a travel option, and True if the travel options are complete, False
+        if some flight searches failed or missed the deadline
+    """
+    logger.info("finding all travel options")
+    failed_airport_pairs = []
+    # Set with the gas price and the ground travel options once they are found, for the air travel options to use
+    ground_travel_future = Future()
+
+    def find_air_travel_options():
+        """ Find the airports, their driving legs and then the air travel options, all under the deadline """
+        with span("airport_lookup"):
+            origin_airports, destination_airports = find_candidate_airports(
+                origin_lat=trip_params["origin_lat"],
+                origin_lon=trip_params["origin_lon"],
+                destination_lat=trip_params["destination_lat"],
+                destination_lon=trip_params["destination_lon"],
+            )
+        with span("distance_matrix"):
+            driving_legs = get_trip_driving_legs(
+                origin_lat=trip_params["origin_lat"],
+                origin_lon=trip_params["origin_lon"],
+                destination_lat=trip_params["destination_lat"],
+                destination_lon=trip_params["destination_lon"],
+                origin_airports=origin_airports,
+                destination_airports=destination_airports,
+            )
+        gas_cost_per_liter, ground_travel_options = ground_travel_future.result()
+
+        known_costs = None
+        if limit is not None:
+            # The costs of the ground travel options let the air travel options skip more airport pairs
+            known_costs = [
+                get_equivalent_travel_cost(
+                    option["total_cost"], option["travel_time_seconds"],
+                    traveler_params["value_one_hour"], traveler_params["value_ten_hours"])
+                for option in ground_travel_options
+            ]
+
+        return get_all_air_travel_options(
+            origin_lat=trip_params["origin_lat"],
+            origin_lon=trip_params["origin_lon"],
+            destination_lat=trip_params["destination_lat"],
+            destination_lon=trip_params["destination_lon"],
+            travel_date=trip_params["travel_date"],
+            origin_airports=origin_airports,
+            destination_airports=destination_airports,
+            driving_legs=driving_legs,
+            gas_cost_per_liter=gas_cost_per_liter,
+            deadline=deadline,
+            on_options=on_options,
+            traveler_params=traveler_params,
+            limit=limit,
+            known_costs=known_costs,
+            travel_date_to=trip_params.get("travel_date_to"),
+            frontier_only=frontier_only,
+            on_failure=failed_airport_pairs.extend,
+        )
+
+    air_travel_future = AIR_TRAVEL_EXECUTOR.submit(find_air_travel_options)
+
+    # The ground travel options only need the origin to destination leg and the gas price, so they are found here
+    # while the airports are looked up, and never wait on Skypicker
+    try:
+        with span("gas_lookup"):
+            gas_cost_per_liter = get_gas_cost_per_liter(
+                latitude=trip_params["origin_lat"], longitude=trip_params["origin_lon"])
+        ground_travel_options = get_all_ground_travel_options(
+            origin_lat=trip_params["origin_lat"],
+            origin_lon=trip_params["origin_lon"],
+            destination_lat=trip_params["destination_lat"],
+            destination_lon=trip_params["destination_lon"],
+            travel_date=trip_params["travel_date"],
+            gas_cost_per_liter=gas_cost_per_liter,
+        )
+    except Exception as e:
+        ground_travel_future.set_exception(e)
+        raise
+    ground_travel_future.set_result((gas_cost_per_liter, ground_travel_options))
+    if on_options is not None:
+        on_options(ground_travel_options)
+
+    try:
+        # The air travel options abandon their own unfinished flight searches at the deadline, so only a short grace
+        # period is needed to let them assemble the flights that were found
+        deadline_grace_seconds = 1
+        air_travel_options = air_travel_future.result(timeout=max(0, deadline - time.time()) + deadline_grace_seconds)
+    except TimeoutError:
+        is_started = not air_travel_future.cancel()
+        logger.warning("air travel options missed the deadline", is_started=is_started)
+        return ground_travel_options, False
+
+    if failed_airport_pairs:
+        logger.warning("travel options are incomplete", num_failed_airport_pairs=len(failed_airport_pairs))
+    return air_travel_options + ground_travel_options, not failed_airport_pairs
+
+
+def _make_travel_options_entry(travel_options):
+    """
+    Keep travel options with their ranking columns, as they are cached
+    :param travel_options: list of dicts: each dict is a travel option
+    :return: dict: the `options`, and their `columns` from `get_ranking_columns`
+    """
+    return {"options": travel_options, "columns": get_ranking_columns(travel_options)}
+
+
+def get_travel_options(trip_params, deadline_seconds=None, on_options=None, on_incomplete=None, is_caching=True):
+    """
+    Get all of the travel options of a trip, without ordering them. The travel options do not depend on the traveler,
+    so they are cached by the trip's handle, and concurrent requests for the same trip share a single computation.
+    :param trip_params: dict: parameters relating to the trip itself
+    :param deadline_seconds: float: number of seconds to wait for the air travel options before returning without the
+        unfinished flight searches (defaults to TRAVEL_DEADLINE_SECONDS). Incomplete travel options, missing the
+        flights of searches that failed or missed the deadline, are not cached.
+    :param on_options: function: called with lists of travel options (as dicts) as soon as they are found, or once
+        with all of them if they are cached or shared
+    :param on_incomplete: function: called without arguments if the travel options are incomplete
+    :param is_caching: boolean: if False, travel options that are found are not cached, e.g. for batch trips, which
+        would evict the interactive requests' travel options and their handles. Cached travel options are still used.
+    :return: list of dicts: each dict is a travel option, and each key is some information about the travel option
+    """
+    return list(_get_travel_options_entry(
+        trip_params, deadline_seconds=deadline_seconds, on_options=on_options, on_incomplete=on_incomplete,
+        is_caching=is_caching)["options"])
+
+
+def _get_travel_options_entry(trip_params, deadline_seconds=None, on_options=None, on_incomplete=None,
+                              is_caching=True):
+    """
+    Get all of the travel options of a trip with their ranking columns, as `get_travel_options` does
+    :return: dict: the travel options, as made by `_make_travel_options_entry`, which must not be modified
+    """
+    if deadline_seconds is None:
+        deadline_seconds = float(os.getenv("TRAVEL_DEADLINE_SECONDS", 150))
+    trip_handle = get_trip_handle(trip_params)
+
+    entry = TRAVEL_OPTIONS_CACHE.get(trip_handle)
+    is_shared = entry is not None
+    is_complete = True
+    if entry is None:
+        def find_travel_options():
+            deadline = time.time() + deadline_seconds
+            found_travel_options, is_found_complete = _find_travel_options(
+                trip_params, deadline, on_options=on_options)
+            found_entry = _make_travel_options_entry(found_travel_options)
+            if is_found_complete and is_caching:
+                TRAVEL_OPTIONS_CACHE.set(trip_handle, found_entry)
+                TRAVEL_OPTIONS_VERSIONS.set(trip_handle, uuid.uuid4().hex)
+            return found_entry, is_found_complete
+
+        # A computation that does not cache its travel options is not shared with one that would
+        (entry, is_complete), is_shared = TRAVEL_OPTIONS_REQUESTS.do((trip_handle, is_caching), find_travel_options)
+
+    logger.info("travel options found", trip_handle=trip_handle, is_shared=is_shared, is_complete=is_complete,
+                **TRAVEL_OPTIONS_CACHE.stats())
+    if is_shared and on_options is not None:
+        on_options(list(entry["options"]))
+    if not is_complete and on_incomplete is not None:
+        on_incomplete()
+
+    return entry
+
+
+def analyze_travel_option(trip_params, traveler_params, deadline_seconds=None, on_options=None, limit=None,
+                          frontier_only=False, on_incomplete=None, is_caching=True):
     """
     Get all of the travel options and order them based on the traveler's preferences
     :param trip_params: dict: parameters relating to the trip itself
@@ -17,40 +359,205 @@ def analyze_travel_option(trip_params, traveler_params):
         destination_lat: float: latitude of the destination
         destination_lon: float: longitude of the destination
         travel_date: string ("dd/mm/yyyy"): departure date
+        travel_date_to: string ("dd/mm/yyyy"): optional last departure date, to compare departing on any date from
+            `travel_date` to this date
     :param traveler_params: dict: parameters relating to the traveler's cost and utility functions
         value_one_hour: int: value in dollars of 1 hour of time
         value_ten_hours: int: value in dollars of 10 hours of time
-    :return: pandas.DataFrame: each row is a travel option, and each column is some information about the travel option.
+    :param deadline_seconds: float: number of seconds to wait for the air travel options before returning without the
+        unfinished flight searches (defaults to TRAVEL_DEADLINE_SECONDS)
+    :param on_options: function: called with lists of unranked travel options (as dicts) as soon as they are found.
+        It may be called from several threads at once.
+    :param limit: int: if given, only the `limit` best travel options are returned, and airport pairs that cannot
+        contain any of them are not searched
+    :param frontier_only: boolean: if True, only the travel options on the Pareto frontier of total cost and travel
+        time are returned, i.e. those that no other travel option beats on both. Unless the trip's travel options are
+        cached, the flights of each airport pair that cannot be on the frontier are discarded as they are found, and
+        `on_options` is only called with the remaining ones.
+    :param on_incomplete: function: called without arguments if the travel options are incomplete, i.e. missing the
+        flights of searches that failed or missed the deadline
+    :param is_caching: boolean: if False, the travel options are not cached when they are found
+    :return: list of dicts: each dict is a travel option, and each key is some information about the travel option.
         Ordered by a best guess of the traveler's preferences.
     """
-    logger.info("finding all travel options")
-    air_travel_options = get_all_air_travel_options(
-        origin_lat=trip_params["origin_lat"],
-        origin_lon=trip_params["origin_lon"],
-        destination_lat=trip_params["destination_lat"],
-        destination_lon=trip_params["destination_lon"],
-        travel_date=trip_params["travel_date"],
-    )
-    ground_travel_options = get_all_ground_travel_options(
-        origin_lat=trip_params["origin_lat"],
-        origin_lon=trip_params["origin_lon"],
-        destination_lat=trip_params["destination_lat"],
-        destination_lon=trip_params["destination_lon"],
-        travel_date=trip_params["travel_date"],
-    )
-    all_travel_options = air_travel_options.append(ground_travel_options, ignore_index=True, sort=False)
+    columns = None
+    is_cached = get_trip_handle(trip_params) in TRAVEL_OPTIONS_CACHE
+    if is_cached or (limit is None and not frontier_only):
+        entry = _get_travel_options_entry(
+            trip_params, deadline_seconds=deadline_seconds, on_options=on_options, on_incomplete=on_incomplete,
+            is_caching=is_caching)
+        all_travel_options, columns = entry["options"], entry["columns"]
+    else:
+        # Incomplete travel options are not cached: airport pairs are skipped with `limit`, and flights with
+        # `frontier_only`, in which case every airport pair is searched
+        if deadline_seconds is None:
+            deadline_seconds = float(os.getenv("TRAVEL_DEADLINE_SECONDS", 150))
+        all_travel_options, is_complete = _find_travel_options(
+            trip_params, time.time() + deadline_seconds, on_options=on_options, traveler_params=traveler_params,
+            limit=None if frontier_only else limit, frontier_only=frontier_only)
+        if not is_complete and on_incomplete is not None:
+            on_incomplete()
 
-    logger.info("analyze the travel options and ordering by preference")
-    all_travel_options = add_equivalent_travel_cost(
-        travel_options=all_travel_options,
-        value_one_hour=traveler_params["value_one_hour"],
-        value_ten_hours=traveler_params["value_ten_hours"],
-    )
-    ordered_travel_options = all_travel_options.sort_values(by=["equivalent_travel_cost"])
-    ordered_travel_options = ordered_travel_options.reset_index(drop=True)
-    ordered_travel_options["rank"] = ordered_travel_options.index
+    if frontier_only:
+        with span("frontier", num_options=len(all_travel_options)):
+            all_travel_options = get_pareto_frontier(all_travel_options)
+        columns = None
+
+    return rank_travel_options(all_travel_options, traveler_params, limit=limit, columns=columns)
+
+
+def rerank_travel_options(trip_handle, traveler_params, limit=None):
+    """
+    Order the cached travel options of a trip based on new traveler's preferences, without finding them again
+    :param trip_handle: string: handle of the trip's travel options, from `get_trip_handle`
+    :param traveler_params: dict: parameters relating to the traveler's cost and utility functions
+    :param limit: int: if given, only the `limit` best travel options are returned
+    :return: list of dicts: the ordered travel options, or None if the trip's travel options are not cached
+    """
+    entry = TRAVEL_OPTIONS_CACHE.get(trip_handle)
+    if entry is None:
+        return None
+
+    return rank_travel_options(entry["options"], traveler_params, limit=limit, columns=entry["columns"])
+
+
+def rerank_travel_options_for_travelers(trip_handle, traveler_profiles, limit=None):
+    """
+    Order the cached travel options of a trip for many travelers' preferences, without finding them again
+    :param trip_handle: string: handle of the trip's travel options, from `get_trip_handle`
+    :param traveler_profiles: list of dicts: parameters relating to each traveler's cost and utility functions
+    :param limit: int: if given, only the `limit` best travel options of each traveler are ranked
+    :return: dict: the travel options and the ranking of each traveler profile, as returned by
+        `rank_travel_options_for_travelers`, or None if the trip's travel options are not cached
+    """
+    entry = TRAVEL_OPTIONS_CACHE.get(trip_handle)
+    if entry is None:
+        return None
+
+    return rank_travel_options_for_travelers(
+        entry["options"], traveler_profiles, limit=limit, columns=entry["columns"])
+
+
+def _prefetch_batch(trip_params_list, on_progress=None):
+    """
+    Resolve the upstream lookups of many trips ahead of time, so that each distinct airport lookup, driving leg, gas
+    price and airport pair is requested once for the whole batch, and the trips are then answered from the caches. A
+    phase that fails is logged and skipped, and its trips fall back to their own lookups when they are analyzed.
+    :param trip_params_list: list of dicts: parameters relating to each trip itself
+    :param on_progress: function: called with the name of each phase as it starts
+    """
+    def run_phase(phase, prefetch):
+        logger.info("batch phase started", phase=phase, num_trips=len(trip_params_list))
+        if on_progress is not None:
+            on_progress(phase)
+        try:
+            prefetch()
+        except Exception as e:
+            logger.error("batch phase error", phase=phase, exception=e)
+
+    run_phase("airports", lambda: prefetch_nearby_airports(
+        [(trip["origin_lat"], trip["origin_lon"]) for trip in trip_params_list] +
+        [(trip["destination_lat"], trip["destination_lon"]) for trip in trip_params_list]))
+
+    trips_airports = []
+    for trip in trip_params_list:
+        try:
+            trips_airports.append((trip, find_candidate_airports(
+                trip["origin_lat"], trip["origin_lon"], trip["destination_lat"], trip["destination_lon"])))
+        except Exception as e:
+            logger.error("batch trip airports error", exception=e)
+
+    run_phase("driving_legs", lambda: prefetch_driving_legs([
+        leg
+        for trip, (origin_airports, destination_airports) in trips_airports
+        for leg in get_trip_driving_leg_locations(
+            trip["origin_lat"], trip["origin_lon"], trip["destination_lat"], trip["destination_lon"],
+            origin_airports, destination_airports).values()
+    ]))
+
+    run_phase("gas_prices", lambda: prefetch_gas_prices(
+        [(trip["origin_lat"], trip["origin_lon"]) for trip in trip_params_list]))
+
+    def prefetch_all_flights():
+        airport_pairs_by_dates = OrderedDict()
+        for trip, (origin_airports, destination_airports) in trips_airports:
+            dates = (trip["travel_date"], trip.get("travel_date_to") or trip["travel_date"])
+            airport_pairs = airport_pairs_by_dates.setdefault(dates, [])
+            airport_pairs.extend((o, d) for o in origin_airports for d in destination_airports)
+        for (date_from, date_to), airport_pairs in airport_pairs_by_dates.items():
+            try:
+                prefetch_flights(airport_pairs, date_from, date_to)
+            except Exception as e:
+                logger.error("batch flights error", date_from=date_from, date_to=date_to, exception=e)
+
+    run_phase("flights", prefetch_all_flights)
+
+
+def _get_batch_chunk_size():
+    """
+    Get the number of trips of a batch whose upstream lookups are prefetched together. The prefetched results are
+    kept in the caches until the trips are analyzed, so a chunk must not need more entries than any cache holds.
+    :return: int: the number of trips, at least 1
+    """
+    max_airports = int(os.getenv("MAX_AIRPORTS_PER_SIDE", 5))
+    entries_per_trip = [
+        (AIRPORT_CACHE, 2),
+        (DISTANCE_MATRIX_CACHE, 1 + 2 * max_airports),
+        (GAS_PRICE_CACHE, 1),
+        (FLIGHT_CACHE, max_airports * max_airports),
+    ]
+    return max(1, min(cache.maxsize // max(1, num_entries) for cache, num_entries in entries_per_trip))
+
+
+def analyze_travel_options_batch(trips, on_progress=None, on_result=None):
+    """
+    Get and order the travel options of many trips. The upstream lookups are deduplicated across each chunk of trips
+    before any of them is made, so the cost of a batch grows with its number of distinct airports and driving legs
+    rather than its number of trips. Chunks are sized by `_get_batch_chunk_size`, so that their prefetched lookups are
+    not evicted from the caches before their trips are analyzed. Its upstream calls have the batch priority class, so
+    they wait for the interactive requests' calls when the upstream rate limits are reached. The travel options it
+    finds are not cached, so that a large batch does not evict those of the interactive requests.
+    :param trips: list of dicts: each dict holds the `trip_params`, the `traveler_params` and an optional `limit` of a
+        trip, as taken by `analyze_travel_option`
+    :param on_progress: function: called with the name of the current phase and the number of trips done so far
+    :param on_result: function: called with the index of each trip, its ordered travel options (or None if they could
+        not be found), its error message (or None) and True if its travel options are incomplete, as soon as the trip
+        is done
+    :return: list of lists of dicts: the ordered travel options of each trip, or None for the trips that failed
+    """
+    def report_progress(phase, trips_completed=0):
+        if on_progress is not None:
+            on_progress(phase, trips_completed)
+
+    chunk_size = _get_batch_chunk_size()
+    results = []
+    with request_priority(PRIORITY_BATCH):
+        for i, trip in enumerate(trips):
+            if i % chunk_size == 0:
+                uncached_trip_params = [
+                    chunk_trip["trip_params"] for chunk_trip in trips[i:i + chunk_size]
+                    if get_trip_handle(chunk_trip["trip_params"]) not in TRAVEL_OPTIONS_CACHE
+                ]
+                _prefetch_batch(uncached_trip_params, on_progress=lambda phase: report_progress(phase, i))
+
+            report_progress("trips", i)
+            incomplete = []
+            try:
+                ordered_travel_options = analyze_travel_option(
+                    trip["trip_params"], trip["traveler_params"], limit=trip.get("limit"),
+                    on_incomplete=lambda: incomplete.append(True), is_caching=False)
+                error = None
+            except Exception as e:
+                logger.error("batch trip error", index=i, exception=e)
+                ordered_travel_options = None
+                error = str(e)
+
+            results.append(ordered_travel_options)
+            if on_result is not None:
+                on_result(i, ordered_travel_options, error, bool(incomplete))
+    report_progress("done", len(trips))
 
-    return ordered_travel_options
+    return results
 
 
 def main():
@@ -73,9 +580,10 @@ def main():
     ordered_travel_options = analyze_travel_option(trip_params, traveler_params)
 
     if create_new_fixture:
-        ordered_travel_options.to_json("trip_planner_api/fixtures/travel_options.json", orient="records")
+        with open("trip_planner_api/fixtures/travel_options.json", "w") as f:
+            json.dump(ordered_travel_options, f)
     else:
-        print(ordered_travel_options)
+        print(to_dataframe(ordered_travel_options))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import threading
+import time
+
+import structlog
+
+from trip_planner_api.cache import get_sqlite_path
+from trip_planner_api.metrics import PRIORITY_BATCH
+from trip_planner_api.metrics import get_request_priority
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+
+class RateLimitTimeoutError(Exception):
+    """ Raised when an upstream call waited longer than allowed for its rate limit """
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the rate of the calls to an upstream API, private to the process. Calls wait
+    until enough tokens are available instead of being rejected. Batch calls leave a reserve of tokens to interactive
+    calls, and hold back entirely while an interactive call is waiting.
+    """
+    # Seconds between two checks of a waiting call, and for which a waiting interactive call holds back batch calls
+    POLL_SECONDS = 0.25
+    INTERACTIVE_WAITING_SECONDS = 0.5
+
+    def __init__(self, name, rate, burst, batch_reserve=0.0):
+        """
+        :param name: string: name of the upstream, used in logs and statistics
+        :param rate: float: number of tokens added per second
+        :param burst: float: maximum number of tokens the bucket holds
+        :param batch_reserve: float: fraction of `burst` that batch calls must leave in the bucket
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.batch_reserve = batch_reserve * burst
+        self.waits = 0
+        self.timeouts = 0
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _transact(self, fn):
+        """
+        Update the state of the bucket atomically
+        :param fn: function: called with the state (tokens, updated_at, interactive_waiting_at) of the bucket, or None
+            for a new bucket, and the current time. Returns the new state and a result.
+        :return: the result of `fn`
+        """
+        with self._lock:
+            self._state, result = fn(self._state, time.time())
+        return result
+
+    def _take(self, state, now, cost, priority):
+        """
+        Take tokens from the bucket if enough of them are available for the priority class
+        :return: tuple: the new state, and the number of seconds to wait before trying again, or 0 if the tokens were
+            taken
+        """
+        tokens, updated_at, interactive_waiting_at = state or (self.burst, now, 0.0)
+        tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+
+        if priority == PRIORITY_BATCH:
+            required = min(self.burst, cost + self.batch_reserve)
+            interactive_waiting_seconds = interactive_waiting_at + self.INTERACTIVE_WAITING_SECONDS - now
+        else:
+            required = cost
+            interactive_waiting_seconds = 0.0
+
+        if tokens >= required and interactive_waiting_seconds <= 0:
+            return (tokens - cost, now, interactive_waiting_at), 0.0
+
+        if priority != PRIORITY_BATCH:
+            interactive_waiting_at = now
+        wait_seconds = max((required - tokens) / self.rate, interactive_waiting_seconds)
+        return (tokens, now, interactive_waiting_at), wait_seconds
+
+    def acquire(self, cost=1, priority=None, max_wait_seconds=None):
+        """
+        Wait until tokens are available, and take them
+        :param cost: float: number of tokens to take, at most `burst`
+        :param priority: string: priority class of the call (defaults to the current request's priority class)
+        :param max_wait_seconds: float: seconds to wait at most (defaults to RATE_LIMIT_MAX_WAIT_SECONDS)
+        :return: float: the number of seconds waited
+        """
+        cost = min(cost, self.burst)
+        priority = priority or get_request_priority()
+        if max_wait_seconds is None:
+            max_wait_seconds = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", 60))
+
+        start = time.time()
+        while True:
+            wait_seconds = self._transact(lambda state, now: self._take(state, now, cost, priority))
+            waited_seconds = time.time() - start
+            if wait_seconds <= 0:
+                if waited_seconds > 0.001:
+                    with self._lock:
+                        self.waits += 1
+                return waited_seconds
+
+            if waited_seconds + wait_seconds > max_wait_seconds:
+                with self._lock:
+                    self.timeouts += 1
+                raise RateLimitTimeoutError("{} rate limit exceeded after waiting {:.1f}s".format(
+                    self.name, waited_seconds))
+            time.sleep(min(wait_seconds, self.POLL_SECONDS))
+
+    def drain(self):
+        """ Empty the bucket, e.g. when the upstream responds that its quota is exceeded """
+        def empty(state, now):
+            return (0.0, now, state[2] if state else 0.0), None
+
+        self._transact(empty)
+        logger.warning("upstream rate limit drained", upstream=self.name)
+
+    def stats(self):
+        """
+        Report the usage of the rate limit. Waits and timeouts are counted by this process only.
+        :return: dict: name, rate, burst, number of calls that waited and number of calls that gave up waiting
+        """
+        with self._lock:
+            return {"name": self.name, "rate": self.rate, "burst": self.burst, "waits": self.waits,
+                    "timeouts": self.timeouts}
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """
+    Token bucket stored in a SQLite database file, so that its rate is shared by every process on the host. Each
+    update is an immediate transaction. Errors are logged and fall back to a bucket private to the process.
+    """
+    def __init__(self, name, rate, burst, batch_reserve, path):
+        """
+        :param name: string: name of the upstream, used as its key in the database and in logs and statistics
+        :param rate: float: number of tokens added per second
+        :param burst: float: maximum number of tokens the bucket holds
+        :param batch_reserve: float: fraction of `burst` that batch calls must leave in the bucket
+        :param path: string: path of the SQLite database file
+        """
+        super(SQLiteTokenBucket, self).__init__(name, rate, burst, batch_reserve=batch_reserve)
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connect()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+            "updated_at REAL NOT NULL, interactive_waiting_at REAL NOT NULL)")
+
+    def _connect(self):
+        """ Get this thread's connection to the database, reconnecting in a forked worker process """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=float(os.getenv("CACHE_SQLITE_TIMEOUT_SECONDS", 5)), isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transact(self, fn):
+        try:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT tokens, updated_at, interactive_waiting_at FROM rate_limits WHERE name = ?",
+                    (self.name,)).fetchone()
+                state, result = fn(row, time.time())
+                connection.execute(
+                    "INSERT OR REPLACE INTO rate_limits (name, tokens, updated_at, interactive_waiting_at) "
+                    "VALUES (?, ?, ?, ?)", (self.name,) + tuple(state))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return result
+        except sqlite3.Error as e:
+            logger.warning("rate limit database error", upstream=self.name, exception=e)
+            return super(SQLiteTokenBucket, self)._transact(fn)
+
+
+def make_rate_limit(name, default_rate, default_burst):
+    """
+    Create the rate limit of an upstream API from its <NAME>_RATE_LIMIT_PER_SECOND and <NAME>_RATE_LIMIT_BURST, with
+    the backend set by RATE_LIMIT_BACKEND: "sqlite" (the default) for a SQLiteTokenBucket in RATE_LIMIT_SQLITE_PATH
+    (see `get_sqlite_path`) shared by every worker process on the host, or "memory" for a TokenBucket private to the
+    process, which only keeps to the quota with a single worker process
+    :param name: string: name of the upstream
+    :param default_rate: float: number of calls (or elements) allowed per second, if not set
+    :param default_burst: float: number of calls (or elements) allowed at once, if not set
+    :return: TokenBucket or SQLiteTokenBucket: the rate limit, or None if the rate is 0
+    """
+    rate = float(os.getenv("{}_RATE_LIMIT_PER_SECOND".format(name.upper()), default_rate))
+    if rate <= 0:
+        return None
+    burst = float(os.getenv("{}_RATE_LIMIT_BURST".format(name.upper()), default_burst))
+    batch_reserve = float(os.getenv("RATE_LIMIT_BATCH_RESERVE", 0.2))
+
+    backend = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+    if backend == "sqlite":
+        path = get_sqlite_path("RATE_LIMIT_SQLITE_PATH", "rate_limits.sqlite3")
+        return SQLiteTokenBucket(name=name, rate=rate, burst=burst, batch_reserve=batch_reserve, path=path)
+    if backend != "memory":
+        raise ValueError("unsupported rate limit backend: {}".format(backend))
+
+    # Each worker process has its own bucket, so together they would send the quota once per worker
+    num_workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    if num_workers > 1:
+        logger.warning("rate limit is private to each worker process, use RATE_LIMIT_BACKEND=sqlite",
+                       upstream=name, num_workers=num_workers, rate=rate, total_rate=rate * num_workers)
+    return TokenBucket(name=name, rate=rate, burst=burst, batch_reserve=batch_reserve)
@@ -0,0 +1,173 @@
+import os
+import random
+import threading
+import time
+
+import requests
+import structlog
+from requests.adapters import HTTPAdapter
+
+from trip_planner_api.metrics import UPSTREAM_QUEUE_SECONDS
+from trip_planner_api.metrics import UPSTREAM_REQUEST_SECONDS
+from trip_planner_api.rate_limit import make_rate_limit
+
+structlog.configure(logger_factory=structlog.PrintLoggerFactory())
+logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """ Raised when an upstream is not called because it has been failing """
+
+
+class UpstreamClient(object):
+    """
+    HTTP client for one upstream API, with a pool of keep-alive connections, a rate limit, timeouts, retries with
+    jittered exponential backoff, a circuit breaker, and latency and error counters
+    """
+    def __init__(self, name, pool_size=None, connect_timeout=None, read_timeout=None, max_retries=None,
+                 backoff_seconds=None, failure_threshold=None, reset_seconds=None, rate_limit=None):
+        """
+        :param name: string: name of the upstream, used in logs and statistics
+        :param pool_size: int: maximum number of connections kept open (defaults to UPSTREAM_POOL_SIZE)
+        :param connect_timeout: float: seconds to wait for a connection (defaults to UPSTREAM_CONNECT_TIMEOUT_SECONDS)
+        :param read_timeout: float: seconds to wait for a response (defaults to UPSTREAM_READ_TIMEOUT_SECONDS)
+        :param max_retries: int: number of retries after a failed request (defaults to UPSTREAM_MAX_RETRIES)
+        :param backoff_seconds: float: base delay before retrying (defaults to UPSTREAM_BACKOFF_SECONDS)
+        :param failure_threshold: int: number of consecutive failed calls that opens the circuit (defaults to
+            UPSTREAM_CIRCUIT_FAILURE_THRESHOLD)
+        :param reset_seconds: float: seconds the circuit stays open before a trial call is let through (defaults to
+            UPSTREAM_CIRCUIT_RESET_SECONDS)
+        :param rate_limit: TokenBucket: rate limit that each request waits for, or None for no rate limit
+        """
+        self.name = name
+        self.rate_limit = rate_limit
+        pool_size = pool_size or int(os.getenv("UPSTREAM_POOL_SIZE", 16))
+        self.timeout = (
+            connect_timeout or float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_SECONDS", 3.05)),
+            read_timeout or float(os.getenv("UPSTREAM_READ_TIMEOUT_SECONDS", 30)),
+        )
+        self.max_retries = int(os.getenv("UPSTREAM_MAX_RETRIES", 2)) if max_retries is None else max_retries
+        self.backoff_seconds = backoff_seconds or float(os.getenv("UPSTREAM_BACKOFF_SECONDS", 0.5))
+        self.failure_threshold = failure_threshold or int(os.getenv("UPSTREAM_CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.reset_seconds = reset_seconds or float(os.getenv("UPSTREAM_CIRCUIT_RESET_SECONDS", 30))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._counters = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "rejected": 0,
+            "latency_seconds_total": 0.0,
+            "latency_seconds_max": 0.0,
+        }
+
+    def _check_circuit(self):
+        """ Raise CircuitOpenError if the circuit is open, letting a trial call through once it is due """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.time() - self._opened_at < self.reset_seconds:
+                self._counters["rejected"] += 1
+                raise CircuitOpenError("{} circuit is open".format(self.name))
+            # Half open: let this call through, and reopen the circuit right away if it fails
+            self._opened_at = None
+            self._consecutive_failures = self.failure_threshold - 1
+
+    def _record(self, latency_seconds, is_error):
+        """ Update the counters and the latency histogram after a request """
+        UPSTREAM_REQUEST_SECONDS.observe(self.name, latency_seconds)
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["latency_seconds_total"] += latency_seconds
+            self._counters["latency_seconds_max"] = max(self._counters["latency_seconds_max"], latency_seconds)
+            if is_error:
+                self._counters["errors"] += 1
+
+    def _record_call(self, is_success):
+        """ Update the circuit breaker after a call and all of its retries """
+        with self._lock:
+            if is_success:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.failure_threshold and self._opened_at is None:
+                self._opened_at = time.time()
+                logger.error("upstream circuit opened", upstream=self.name, failures=self._consecutive_failures)
+
+    def get(self, url, params=None, headers=None, cost=1):
+        """
+        Make a GET request, retrying timeouts, connection errors, and rate limited or server error responses. Each
+        attempt first waits for the rate limit, with the priority class of the current request.
+        :param url: string: URL to request
+        :param params: dict: query string parameters
+        :param headers: dict: request headers
+        :param cost: float: number of rate limit tokens the request uses, e.g. its number of Distance Matrix elements
+        :return: requests.Response: the successful response
+        """
+        self._check_circuit()
+
+        attempt = 0
+        while True:
+            if self.rate_limit is not None:
+                UPSTREAM_QUEUE_SECONDS.observe(self.name, self.rate_limit.acquire(cost=cost))
+
+            start = time.time()
+            try:
+                response = self.session.get(url=url, params=params, headers=headers, timeout=self.timeout)
+                error = None if response.status_code not in RETRY_STATUS_CODES else requests.HTTPError(
+                    "{} responded with {}".format(self.name, response.status_code), response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+            self._record(time.time() - start, is_error=error is not None)
+            if response is not None and response.status_code == 429 and self.rate_limit is not None:
+                self.rate_limit.drain()
+
+            if error is None or attempt >= self.max_retries:
+                break
+
+            attempt += 1
+            delay = random.uniform(0, self.backoff_seconds * (2 ** attempt))
+            logger.warning("retrying upstream request", upstream=self.name, attempt=attempt, delay=delay, error=error)
+            with self._lock:
+                self._counters["retries"] += 1
+            time.sleep(delay)
+
+        self._record_call(is_success=error is None)
+        if error is not None:
+            raise error
+
+        return response
+
+    def stats(self):
+        """
+        Report the usage of the upstream
+        :return: dict: name, circuit state and counters of the upstream
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["name"] = self.name
+            stats["circuit_open"] = self._opened_at is not None
+
+        rate_limit_stats = self.rate_limit.stats() if self.rate_limit is not None else {}
+        stats["rate_limit_waits"] = rate_limit_stats.get("waits", 0)
+        stats["rate_limit_timeouts"] = rate_limit_stats.get("timeouts", 0)
+        return stats
+
+
+SKYPICKER = UpstreamClient("skypicker", rate_limit=make_rate_limit("skypicker", default_rate=10, default_burst=20))
+# The Distance Matrix quota counts elements (origins times destinations) rather than requests
+GOOGLE_MAPS = UpstreamClient(
+    "google_maps", rate_limit=make_rate_limit("google_maps", default_rate=1000, default_burst=1000))
+MYGASFEED = UpstreamClient("mygasfeed", rate_limit=make_rate_limit("mygasfeed", default_rate=5, default_burst=10))
+
+UPSTREAMS = [SKYPICKER, GOOGLE_MAPS, MYGASFEED]
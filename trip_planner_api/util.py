@@ -1,13 +1,32 @@
 import json
+import math
 import os
-import requests
+from collections import OrderedDict
 
 import structlog
 
+from trip_planner_api.cache import make_cache
+from trip_planner_api.metrics import RequestContextExecutor
+from trip_planner_api.upstream import GOOGLE_MAPS
+from trip_planner_api.upstream import MYGASFEED
+
 structlog.configure(logger_factory=structlog.PrintLoggerFactory())
 logger = structlog.get_logger(processors=[structlog.processors.JSONRenderer()])
 
-GAS_COST_PER_GALLON = None
+DEFAULT_GAS_COST_PER_LITER = 0.75
+GAS_PRICE_NOT_FOUND = -1.0
+
+GAS_PRICE_CACHE = make_cache(
+    name="gas_prices",
+    maxsize=int(os.getenv("GAS_PRICE_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("GAS_PRICE_CACHE_TTL_SECONDS", 21600)),
+)
+
+DISTANCE_MATRIX_CACHE = make_cache(
+    name="distance_matrix",
+    maxsize=int(os.getenv("DISTANCE_MATRIX_CACHE_SIZE", 100000)),
+    ttl=float(os.getenv("DISTANCE_MATRIX_CACHE_TTL_SECONDS", 21600)),
+)
 
 
 def get_seconds_from_duration_string(duration_string, duration_format):
@@ -60,68 +79,191 @@ def get_distance_string_from_meters(distance_meters, distance_format):
         raise Exception(msg)
 
 
-def get_gas_cost(distance_meters, latitude, longitude):
+def get_haversine_distance_meters(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great-circle distance between two coordinates
+    :param lat1: float: latitude of the first coordinate
+    :param lon1: float: longitude of the first coordinate
+    :param lat2: float: latitude of the second coordinate
+    :param lon2: float: longitude of the second coordinate
+    :return: float: distance in meters
+    """
+    earth_radius_meters = 6371008.8
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+
+    h = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * earth_radius_meters * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _get_gas_price_region(latitude, longitude):
+    """ Get the region of GAS_PRICE_REGION_DEGREES containing a location, which gas prices are cached by """
+    region_size = float(os.getenv("GAS_PRICE_REGION_DEGREES", 1.0))
+    return int(math.floor(latitude / region_size)), int(math.floor(longitude / region_size))
+
+
+def get_gas_cost_per_liter(latitude, longitude):
+    """
+    Look up the current gas price near a location. Prices are cached per region of GAS_PRICE_REGION_DEGREES, and
+    failed lookups are cached for a shorter time so that they are not retried on every call.
+    :param latitude: float: latitude of the location
+    :param longitude: float: longitude of the location
+    :return: float: gas cost per liter in U.S. dollars, or a default cost if the price could not be found
+    """
+    region = _get_gas_price_region(latitude, longitude)
+
+    cost_per_liter = GAS_PRICE_CACHE.get(region)
+    if cost_per_liter is not None:
+        return DEFAULT_GAS_COST_PER_LITER if cost_per_liter == GAS_PRICE_NOT_FOUND else cost_per_liter
+
+    url = "{route}/{latitude}/{longitude}/{distance}/{fuel_type}/{sort_by}/{apikey}.json?".format(
+        route=os.getenv("MYGASFEED_API_ROUTE_DEV"),
+        latitude=latitude,
+        longitude=longitude,
+        distance=50,
+        fuel_type="reg",
+        sort_by="distance",
+        apikey=os.getenv("MYGASFEED_API_KEY_DEV"),
+    )
+    headers = {"Accept": "application/json"}
+
+    cost_per_liter = GAS_PRICE_NOT_FOUND
+    try:
+        r = MYGASFEED.get(url=url, headers=headers).text
+        json_begin = r.find("{\"status\":")
+        r = r[json_begin:]
+        r = json.loads(r)
+
+        if r["status"]["code"] == 200:
+            if len(r["stations"]) == 0:
+                logger.info("nearby gas prices not found, use default gas cost per liter: {}".format(
+                    DEFAULT_GAS_COST_PER_LITER))
+                cost_per_liter = DEFAULT_GAS_COST_PER_LITER
+            else:
+                cost_per_gallon = float(r["stations"][0]["reg_price"])
+                logger.info("gas price found through myGasFeed", cost_per_gallon=cost_per_gallon, region=region)
+                cost_per_liter = cost_per_gallon / 3.78541
+        else:
+            logger.error("myGasFeed responded with bad status code",
+                         status_code=r["status"]["code"],
+                         default_cost_per_liter=DEFAULT_GAS_COST_PER_LITER,
+                         url=url)
+    except Exception as e:
+        logger.error("myGasFeed request error",
+                     default_cost_per_liter=DEFAULT_GAS_COST_PER_LITER,
+                     url=url,
+                     exception=e)
+
+    if cost_per_liter == GAS_PRICE_NOT_FOUND:
+        GAS_PRICE_CACHE.set(region, cost_per_liter, ttl=float(os.getenv("GAS_PRICE_FAILURE_TTL_SECONDS", 300)))
+        return DEFAULT_GAS_COST_PER_LITER
+
+    GAS_PRICE_CACHE.set(region, cost_per_liter)
+    return cost_per_liter
+
+
+def prefetch_gas_prices(locations):
+    """
+    Look up the gas prices near many locations ahead of time. Locations within the same region share a single lookup.
+    :param locations: list of tuples: (latitude, longitude) of the locations
+    """
+    locations_by_region = {}
+    for latitude, longitude in locations:
+        locations_by_region.setdefault(_get_gas_price_region(latitude, longitude), (latitude, longitude))
+
+    missing = [location for region, location in locations_by_region.items() if region not in GAS_PRICE_CACHE]
+    logger.info("prefetching gas prices", num_locations=len(locations), num_regions=len(locations_by_region),
+                num_missing=len(missing))
+    if not missing:
+        return
+
+    max_workers = int(os.getenv("GAS_PRICE_CONCURRENCY", 4))
+    with RequestContextExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+        list(executor.map(lambda location: get_gas_cost_per_liter(*location), missing))
+
+
+def get_gas_cost(distance_meters, latitude, longitude, cost_per_liter=None):
     """
     Estimate the gas cost for driving the given distance by using an average fuel consumption and the current gas price
     :param distance_meters: int: distance in meters
     :param latitude: float: latitude of the origin
     :param longitude: float: longitude of the origin
+    :param cost_per_liter: float: gas cost per liter, looked up with `get_gas_cost_per_liter` if not given
     :return: int: gas cost in U.S. dollars
     """
-    global GAS_COST_PER_GALLON
-
     liters_per_meter = 0.0001
     liters_used = distance_meters * liters_per_meter
-    cost_per_liter = 0.75
-    cost_per_gallon = None
-
-    if GAS_COST_PER_GALLON is None:
-        url = "{route}/{latitude}/{longitude}/{distance}/{fuel_type}/{sort_by}/{apikey}.json?".format(
-            route=os.getenv("MYGASFEED_API_ROUTE_DEV"),
-            latitude=latitude,
-            longitude=longitude,
-            distance=50,
-            fuel_type="reg",
-            sort_by="distance",
-            apikey=os.getenv("MYGASFEED_API_KEY_DEV"),
-        )
-        headers = {"Accept": "application/json"}
-
-        try:
-            r = requests.get(url=url, headers=headers).text
-            json_begin = r.find("{\"status\":")
-            r = r[json_begin:]
-            r = json.loads(r)
-
-            if r["status"]["code"] == 200:
-                if len(r["stations"]) == 0:
-                    logger.info("nearby gas prices not found, use default gas cost per liter: {}".format(cost_per_liter))
-                else:
-                    cost_per_gallon = float(r["stations"][0]["reg_price"])
-                    logger.info("gas price found through myGasFeed", cost_per_gallon=cost_per_gallon)
-                    GAS_COST_PER_GALLON = cost_per_gallon
-            else:
-                logger.error("myGasFeed responded with bad status code",
-                             status_code=r["status"]["code"],
-                             default_cost_per_liter=cost_per_liter,
-                             url=url)
-        except Exception as e:
-            logger.error("myGasFeed request error",
-                         default_cost_per_liter=cost_per_liter,
-                         url=url,
-                         exception=e)
-    else:
-        cost_per_gallon = GAS_COST_PER_GALLON
 
-    if cost_per_gallon:
-        cost_per_liter = cost_per_gallon / 3.78541
+    if cost_per_liter is None:
+        cost_per_liter = get_gas_cost_per_liter(latitude, longitude)
 
     return liters_used * cost_per_liter
 
 
+def _get_location_key(location, precision):
+    """
+    Normalize a Distance Matrix location so that nearby coordinates share the same cache key
+    :param location: string: a "latitude,longitude" pair, or any other valid Distance Matrix location
+    :param precision: int: number of decimal places to round coordinates to
+    :return: tuple or string: rounded coordinates, or the stripped location if it is not a coordinate
+    """
+    try:
+        latitude, longitude = location.split(",")
+        return round(float(latitude), precision), round(float(longitude), precision)
+    except ValueError:
+        return location.strip()
+
+
+def _chunk_distance_matrix_block(rows, cols, max_dimension=25, max_elements=100):
+    """
+    Split a block of a distance matrix into chunks that fit within the Distance Matrix API's per-request limits
+    :param rows: list of ints: indices of the origins in the block
+    :param cols: list of ints: indices of the destinations in the block
+    :param max_dimension: int: maximum number of origins or destinations in a request
+    :param max_elements: int: maximum number of elements (origins times destinations) in a request
+    :return: list of tuples: (origin indices, destination indices) of each chunk
+    """
+    chunks = []
+    for i in range(0, len(cols), max_dimension):
+        col_chunk = cols[i:i + max_dimension]
+        num_rows = max(1, min(max_dimension, max_elements // len(col_chunk)))
+        for j in range(0, len(rows), num_rows):
+            chunks.append((rows[j:j + num_rows], col_chunk))
+    return chunks
+
+
+def _request_distance_matrix(origins, destinations):
+    """
+    Make a single request to the Google Maps Distance Matrix API.
+    :param origins: list of strings: valid Distance Matrix locations of the origins
+    :param destinations: list of strings: valid Distance Matrix locations of the destinations
+    :return: list of lists: distance and duration of each element, indexed by origin and then destination
+    """
+    url = "{route}/{resource}/{format}".format(
+        route=os.getenv("GOOGLE_MAPS_API_ROUTE"),
+        resource="distancematrix",
+        format="json",
+    )
+    params = {
+        "key": os.getenv("GOOGLE_MAPS_API_KEY"),
+        "origins": "|".join(origins),
+        "destinations": "|".join(destinations),
+    }
+    r = GOOGLE_MAPS.get(url=url, params=params, cost=len(origins) * len(destinations)).json()
+
+    return [
+        [{k: r["rows"][row]["elements"][col][k] for k in ["distance", "duration"]} for col in range(len(destinations))]
+        for row in range(len(origins))
+    ]
+
+
 def make_distance_matrix_request(origins, destinations, origin_labels, destination_labels, group_by_origins):
     """
     Make a request to the Google Maps Distance Matrix API.
+    Elements are cached by rounded coordinates, and only the uncached elements are requested. Large matrices are split
+    into chunks within the API's per-request limits, which are requested concurrently.
     :param origins: string: any valid input for the Distance Matrix API's `origins` parameter
     :param destinations:  string: any valid input for the Distance Matrix API's `destinations` parameter
     :param origin_labels: list of strings: labels for the origins
@@ -134,17 +276,48 @@ def make_distance_matrix_request(origins, destinations, origin_labels, destinati
     else:
         logger.info("requesting Google Maps Distance Matrix API", origins=origin_labels, destinations=destinations)
 
-    url = "{route}/{resource}/{format}".format(
-        route=os.getenv("GOOGLE_MAPS_API_ROUTE"),
-        resource="distancematrix",
-        format="json",
-    )
-    params = {
-        "key": os.getenv("GOOGLE_MAPS_API_KEY"),
-        "origins": origins,
-        "destinations": destinations,
-    }
-    r = requests.get(url=url, params=params).json()
+    precision = int(os.getenv("DISTANCE_MATRIX_CACHE_PRECISION", 3))
+    origin_locations = origins.split("|")
+    destination_locations = destinations.split("|")
+    origin_keys = [_get_location_key(location, precision) for location in origin_locations]
+    destination_keys = [_get_location_key(location, precision) for location in destination_locations]
+
+    elements = {}
+    missing_cols_by_row = {}
+    for row, origin_key in enumerate(origin_keys):
+        for col, destination_key in enumerate(destination_keys):
+            info = DISTANCE_MATRIX_CACHE.get((origin_key, destination_key))
+            if info is None:
+                missing_cols_by_row.setdefault(row, []).append(col)
+            else:
+                elements[(row, col)] = info
+
+    # Origins missing the same destinations are requested together, so that no cached element is requested again
+    blocks = {}
+    for row, cols in missing_cols_by_row.items():
+        blocks.setdefault(tuple(cols), []).append(row)
+    chunks = [chunk for cols, rows in blocks.items() for chunk in _chunk_distance_matrix_block(rows, list(cols))]
+
+    def request_chunk(chunk):
+        rows, cols = chunk
+        return _request_distance_matrix(
+            origins=[origin_locations[row] for row in rows],
+            destinations=[destination_locations[col] for col in cols],
+        )
+
+    if chunks:
+        logger.info("Distance Matrix elements not cached",
+                    num_missing=sum(len(cols) for cols in missing_cols_by_row.values()),
+                    num_cached=len(elements),
+                    num_requests=len(chunks))
+        max_workers = int(os.getenv("DISTANCE_MATRIX_CONCURRENCY", 4))
+        with RequestContextExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            for (rows, cols), chunk_elements in zip(chunks, executor.map(request_chunk, chunks)):
+                for i, row in enumerate(rows):
+                    for j, col in enumerate(cols):
+                        info = chunk_elements[i][j]
+                        DISTANCE_MATRIX_CACHE.set((origin_keys[row], destination_keys[col]), info)
+                        elements[(row, col)] = info
 
     if group_by_origins:
         distances = {o: {d: None for d in destination_labels} for o in origin_labels}
@@ -155,8 +328,7 @@ def make_distance_matrix_request(origins, destinations, origin_labels, destinati
     num_cols = len(destination_labels)
     for row in range(num_rows):
         for col in range(num_cols):
-            info = r["rows"][row]["elements"][col]
-            info = {k: info[k] for k in ["distance", "duration"]}
+            info = elements[(row, col)]
 
             if group_by_origins:
                 distances[origin_labels[row]][destination_labels[col]] = info
@@ -164,3 +336,132 @@ def make_distance_matrix_request(origins, destinations, origin_labels, destinati
                 distances[destination_labels[col]][origin_labels[row]] = info
 
     return distances
+
+
+def prefetch_driving_legs(legs):
+    """
+    Resolve many driving legs ahead of time, so that later requests for them are answered from DISTANCE_MATRIX_CACHE.
+    Each distinct leg is requested once. Origins that need the same destinations are requested together, so no
+    element that is not asked for is requested.
+    :param legs: list of tuples: (origin, destination) valid Distance Matrix locations of each leg
+    """
+    precision = int(os.getenv("DISTANCE_MATRIX_CACHE_PRECISION", 3))
+
+    destinations_by_origin = OrderedDict()
+    num_legs = 0
+    for origin, destination in legs:
+        origin_key = _get_location_key(origin, precision)
+        destination_key = _get_location_key(destination, precision)
+        if (origin_key, destination_key) in DISTANCE_MATRIX_CACHE:
+            continue
+        origin_destinations = destinations_by_origin.setdefault(origin_key, (origin, OrderedDict()))[1]
+        if destination_key not in origin_destinations:
+            origin_destinations[destination_key] = destination
+            num_legs += 1
+
+    groups = OrderedDict()
+    for origin, destinations in destinations_by_origin.values():
+        groups.setdefault(tuple(destinations), (list(destinations.values()), []))[1].append(origin)
+
+    logger.info("prefetching driving legs", num_missing=num_legs, num_groups=len(groups))
+
+    def request_group(group):
+        destinations, origins = group
+        make_distance_matrix_request(
+            origins="|".join(origins),
+            destinations="|".join(destinations),
+            origin_labels=origins,
+            destination_labels=destinations,
+            group_by_origins=True,
+        )
+
+    if groups:
+        max_workers = int(os.getenv("DISTANCE_MATRIX_CONCURRENCY", 4))
+        with RequestContextExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            list(executor.map(request_group, groups.values()))
+
+
+def get_trip_driving_leg_locations(origin_lat, origin_lon, destination_lat, destination_lon, origin_airports,
+                                   destination_airports):
+    """
+    List the driving legs a trip needs: origin to destination, origin to each origin airport, and each destination
+    airport to destination.
+    :param origin_lat: float: latitude of the origin
+    :param origin_lon: float: longitude of the origin
+    :param destination_lat: float: latitude of the destination
+    :param destination_lon: float: longitude of the destination
+    :param origin_airports: dict: keys are three letter codes of the airports near the origin, and values are
+        dictionaries of airport information
+    :param destination_airports: dict: keys are three letter codes of the airports near the destination, and values
+        are dictionaries of airport information
+    :return: OrderedDict: keys are (origin label, destination label) tuples, where the labels are "origin",
+        "destination" or airport codes, and values are (origin, destination) Distance Matrix locations of the legs
+    """
+    origin = "{},{}".format(origin_lat, origin_lon)
+    destination = "{},{}".format(destination_lat, destination_lon)
+
+    legs = OrderedDict()
+    legs[("origin", "destination")] = (origin, destination)
+    for code, info in origin_airports.items():
+        legs[("origin", code)] = (origin, "{},{}".format(info["latitude"], info["longitude"]))
+    for code, info in destination_airports.items():
+        legs[(code, "destination")] = ("{},{}".format(info["latitude"], info["longitude"]), destination)
+
+    return legs
+
+
+def get_trip_driving_legs(origin_lat, origin_lon, destination_lat, destination_lon, origin_airports,
+                          destination_airports):
+    """
+    Resolve every driving leg a trip needs: origin to destination, origin to each origin airport, and each destination
+    airport to destination. Only these legs are requested, as the origin's row (to the origin airports and the
+    destination) and the destination's column (from the destination airports), which are requested concurrently.
+    :param origin_lat: float: latitude of the origin
+    :param origin_lon: float: longitude of the origin
+    :param destination_lat: float: latitude of the destination
+    :param destination_lon: float: longitude of the destination
+    :param origin_airports: dict: keys are three letter codes of the airports near the origin, and values are
+        dictionaries of airport information
+    :param destination_airports: dict: keys are three letter codes of the airports near the destination, and values
+        are dictionaries of airport information
+    :return: dict: driving legs of the trip
+        driving: dict: distance and duration from the origin to the destination
+        to_airports: dict: keys are origin airport codes, and values are distances and durations to the airports
+        from_airports: dict: keys are destination airport codes, and values are distances and durations from the
+            airports
+    """
+    origin = "{},{}".format(origin_lat, origin_lon)
+    destination = "{},{}".format(destination_lat, destination_lon)
+    origin_airport_codes = list(origin_airports)
+    destination_airport_codes = list(destination_airports)
+
+    def request_destination_column():
+        if not destination_airport_codes:
+            return {}
+        return make_distance_matrix_request(
+            origins="|".join(
+                "{},{}".format(info["latitude"], info["longitude"]) for info in destination_airports.values()),
+            destinations=destination,
+            origin_labels=destination_airport_codes,
+            destination_labels=["destination"],
+            group_by_origins=False,
+        )["destination"]
+
+    with RequestContextExecutor(max_workers=1) as executor:
+        destination_column_future = executor.submit(request_destination_column)
+        origin_row = make_distance_matrix_request(
+            origins=origin,
+            destinations="|".join(
+                ["{},{}".format(info["latitude"], info["longitude"]) for info in origin_airports.values()] +
+                [destination]),
+            origin_labels=["origin"],
+            destination_labels=origin_airport_codes + ["destination"],
+            group_by_origins=True,
+        )["origin"]
+        destination_column = destination_column_future.result()
+
+    return {
+        "driving": origin_row["destination"],
+        "to_airports": {code: origin_row[code] for code in origin_airport_codes},
+        "from_airports": {code: destination_column[code] for code in destination_airport_codes},
+    }